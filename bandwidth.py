@@ -0,0 +1,159 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+import metrics
+
+# Bandwidth of the bot's audio, fitted to the server's limit. Murmur drops the
+# voice packets of a user sending more than the server's max bandwidth over
+# the last second. Like the Mumble client, the Opus bitrate is what is left of
+# the bandwidth once the per-packet overhead (IP, TCP and tunnel headers, as
+# pymumble tunnels the audio over TCP) is taken, and more audio is put in each
+# packet when that leaves too low a bitrate.
+
+AUDIO_PER_PACKET = [0.02, 0.04, 0.06]  # Opus frame durations, one frame per packet
+PACKET_OVERHEAD = 20 + 20 + 6 + 3  # bytes: IP, TCP, tunnel and frame headers (see SoundOutput._set_bandwidth)
+VOICE_HEADER = 4  # bytes counted by murmur besides the Opus data: type, sequence and size
+
+
+def parse_overrides(value):
+    """'key=bandwidth;key=bandwidth' -> list of (key, bandwidth)"""
+    overrides = []
+    for item in value.split(';'):
+        if '=' in item:
+            key, bandwidth = item.rsplit('=', 1)
+            try:
+                overrides.append((key.strip(), int(bandwidth)))
+            except ValueError:
+                logging.error('Invalid bandwidth override: ' + item)
+    return overrides
+
+
+def in_period(period, now):
+    """Whether the time `now` is within 'HH:MM-HH:MM' (which may span midnight)."""
+    try:
+        start, end = [datetime.datetime.strptime(t.strip(), '%H:%M').time() for t in period.split('-')]
+    except ValueError:
+        logging.error('Invalid bandwidth schedule: ' + period)
+        return False
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def get_bitrate(bandwidth, audio_per_packet):
+    return int(bandwidth - PACKET_OVERHEAD * 8 / audio_per_packet)
+
+
+class BandwidthManager:
+    """Chooses the bandwidth and packet duration of a bot's audio output.
+
+    The bandwidth is max_bandwidth, or the override of the bot's channel
+    (bandwidth_channels) or of the current time (bandwidth_schedule), within
+    the limit advertised by the server. The packets sent are counted to report
+    the bitrate actually sent and the packets the server would drop.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.mumble = bot.mumble
+        self.name = 'bandwidth' if bot.name is None else 'bandwidth.' + bot.name
+        self.bandwidth = None
+        self.audio_per_packet = None
+        self.last_update = 0
+        self.sound_output = None
+        self.encoder = None
+        self.lock = threading.Lock()
+        self.sent = collections.deque()  # (time, size) of the packets of the last second
+        self.sent_size = 0
+        self.dropped = 0
+
+    def get_target(self):
+        """(bandwidth, reason) wanted for the audio, before the server limit."""
+        bandwidth, reason = int(self.bot.get_option('bot', 'max_bandwidth')), 'max_bandwidth'
+        now = datetime.datetime.now().time()
+        for period, value in parse_overrides(self.bot.get_option('bot', 'bandwidth_schedule')):
+            if in_period(period, now):
+                bandwidth, reason = value, 'schedule ' + period
+        try:
+            channel = self.mumble.channels[self.mumble.users.myself['channel_id']]['name']
+        except (KeyError, TypeError):
+            channel = None
+        for name, value in parse_overrides(self.bot.get_option('bot', 'bandwidth_channels')):
+            if name == channel:
+                bandwidth, reason = value, 'channel ' + name
+        return bandwidth, reason
+
+    def get_server_limit(self):
+        return getattr(self.mumble, 'server_max_bandwidth', None) or None
+
+    def update(self):
+        """Apply the bandwidth wanted now, if it changed."""
+        self.last_update = time.time()
+        bandwidth, reason = self.get_target()
+        limit = self.get_server_limit()
+        if limit and bandwidth > limit:
+            bandwidth, reason = limit, 'server limit'
+
+        min_bitrate = int(self.bot.get_option('bot', 'min_bitrate'))
+        audio_per_packet = AUDIO_PER_PACKET[-1]
+        for duration in AUDIO_PER_PACKET:
+            if get_bitrate(bandwidth, duration) >= min_bitrate:
+                audio_per_packet = duration
+                break
+
+        sound_output = self.mumble.sound_output
+        if sound_output is not self.sound_output:
+            # pymumble creates a new SoundOutput on reconnection
+            self.sound_output = sound_output
+            self.bandwidth = self.audio_per_packet = None
+        elif (bandwidth, audio_per_packet) == (self.bandwidth, self.audio_per_packet):
+            self.hook()
+            return
+        if audio_per_packet != self.audio_per_packet:
+            sound_output.set_audio_per_packet(audio_per_packet)
+        self.mumble.set_bandwidth(bandwidth)
+        self.bandwidth = bandwidth
+        self.audio_per_packet = audio_per_packet
+        bitrate = get_bitrate(bandwidth, audio_per_packet)
+        logging.info('Bandwidth: {} bps ({}), Opus at {} bps in {} ms packets'.format(
+            bandwidth, reason, bitrate, int(audio_per_packet * 1000)))
+        metrics.gauge(self.name + '.limit', bandwidth)
+        metrics.gauge(self.name + '.bitrate', bitrate)
+        metrics.gauge(self.name + '.audio_per_packet', audio_per_packet)
+        self.hook()
+
+    def hook(self):
+        # count the packets encoded by pymumble; its encoder is replaced when
+        # the codec or the packet duration changes
+        encoder = self.mumble.sound_output.encoder
+        if encoder is None or encoder is self.encoder:
+            return
+        encode = encoder.encode
+
+        def counted_encode(pcm, frame_size):
+            data = encode(pcm, frame_size)
+            self.packet_sent(len(data))
+            return data
+        encoder.encode = counted_encode
+        self.encoder = encoder
+
+    def packet_sent(self, size):
+        # same check as murmur's BandwidthRecord: a packet making the last
+        # second exceed the limit is dropped
+        size += VOICE_HEADER
+        now = time.time()
+        limit = self.get_server_limit()
+        with self.lock:
+            while self.sent and self.sent[0][0] < now - 1:
+                self.sent_size -= self.sent.popleft()[1]
+            if limit and (self.sent_size + size) * 8 > limit:
+                self.dropped += 1
+                metrics.incr(self.name + '.dropped')
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logging.warning('Bandwidth: the server drops audio packets ({} so far)'.format(self.dropped))
+                return
+            self.sent.append((now, size))
+            self.sent_size += size
+            metrics.gauge(self.name + '.sent', self.sent_size * 8)
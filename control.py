@@ -0,0 +1,140 @@
+import logging
+import os
+import random
+import threading
+from multiprocessing.managers import BaseManager
+import variables as var
+import media.url
+import quota
+
+# Fields of the queue entries exposed to the web interface
+item_fields = ['type', 'title', 'path', 'url', 'user', 'duration', 'thumbnail', 'playlist_title']
+
+
+class BotControl:
+    """What the web interface can do with a bot.
+
+    Used directly when the web interface runs in the bot process, and through
+    a ControlClient proxy when it runs in its own process, so everything
+    returned here must be picklable.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.state = None
+        self.lock = threading.Lock()
+
+    def get_name(self):
+        return self.bot.name
+
+    def get_username(self):
+        return self.bot.username
+
+    def get_state(self):
+        # computed once per state version, whatever the number of clients
+        bot = self.bot
+        with self.lock:
+            if self.state and self.state['version'] == bot.version:
+                return self.state
+        version = bot.version
+        items = [{k: m[k] for k in item_fields if k in m} for m in list(bot.playlist)]
+        state = {
+            'version': version,
+            'bot': bot.name,
+            'volume': bot.volume,
+            'is_playing': bot.is_playing,
+            'current': items[0] if items else None,
+            'queue': items[1:],
+        }
+        with self.lock:
+            self.state = state
+        return state
+
+    def wait_change(self, version, timeout):
+        with self.bot.changed:
+            if self.bot.version == version:
+                self.bot.changed.wait(timeout)
+            return self.bot.version
+
+    def get_playlist(self):
+        return [m.copy() for m in list(self.bot.playlist)]
+
+    def add_items(self, items):
+        return self.bot.queue_work(lambda: self.bot.playlist.extend(items) or len(self.bot.playlist)).wait()
+
+    def add_url(self, url, client):
+        """Resolve url on the request pool (the web's requests are limited per
+        client address, like the users' commands) and queue its tracks.
+        Returns quota.submit's (status, value), or ('banned', 0)."""
+        if url.lower() in [i[0] for i in var.db.items('url_ban')]:
+            return 'banned', 0
+
+        def request():
+            entries = media.url.get_url_info(url, 'Web')
+            if not entries:
+                logging.info('Web: could not get metadata for url ' + url)
+                return
+            banned = var.db.options('url_ban')
+            entries = [music for music in entries if music['url'] not in banned
+                       and music['duration'] <= var.config.getint('bot', 'max_track_duration')]
+            if entries:
+                self.add_items(entries)
+        return quota.submit('web:' + client, False, request)
+
+    def remove_items(self, start, end=None):
+        return self.bot.queue_work(lambda: self.bot.remove_items(start, end)).wait()
+
+    def insert_items(self, index, items):
+        return self.bot.queue_work(lambda: self.bot.insert_items(index, items)).wait()
+
+    def move_item(self, src, dst):
+        return self.bot.queue_work(lambda: self.bot.move_item(src, dst)).wait()
+
+    def skip(self, count=1):
+        return self.bot.queue_work(lambda: self.bot.skip(count)).wait()
+
+    def dedupe(self):
+        return self.bot.queue_work(self.bot.dedupe).wait()
+
+    def shuffle(self):
+        def shuffle():
+            upcoming = self.bot.playlist[1:]
+            random.shuffle(upcoming)
+            self.bot.playlist[1:] = upcoming
+        self.bot.queue_work(shuffle).wait()
+
+
+class ControlServer(BaseManager):
+    pass
+
+
+class ControlClient(BaseManager):
+    pass
+
+
+def serve(address, authkey):
+    """Expose the bots and the library to a web interface process."""
+    controls = {bot.name: BotControl(bot) for bot in var.bots}
+    names = [bot.name for bot in var.bots]
+    ControlServer.register('get_names', callable=lambda: names)
+    ControlServer.register('get_control', callable=lambda name: controls[name])
+    ControlServer.register('get_library', callable=lambda: var.library)
+    if os.path.exists(address):
+        os.remove(address)
+    manager = ControlServer(address=address, authkey=authkey)
+    server = manager.get_server()
+    logging.info('Control socket listening on ' + address)
+    t = threading.Thread(target=server.serve_forever, name='control')
+    t.daemon = True
+    t.start()
+
+
+def connect(address, authkey):
+    """From the web interface process: returns (bot controls, library) proxies."""
+    ControlClient.register('get_names')
+    ControlClient.register('get_control')
+    ControlClient.register('get_library')
+    manager = ControlClient(address=address, authkey=authkey)
+    manager.connect()
+    controls = [manager.get_control(name) for name in manager.get_names()._getvalue()]
+    return controls, manager.get_library()
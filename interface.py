@@ -1,14 +1,29 @@
 #!/usr/bin/python3
 
-from flask import Flask, render_template, request, redirect, send_file
+from flask import Flask, render_template, request, redirect, send_file, jsonify, Response, make_response
 import variables as var
 import util
 from datetime import datetime
 import os.path
 import random
+import json
+import gzip
+import logging
+import queue
+import settings
+import control
 from werkzeug.utils import secure_filename
 import errno
+import magic
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from werkzeug.http import parse_content_range_header
 import media
+import media.file
 
 
 class ReverseProxied(object):
@@ -58,21 +73,27 @@ def init_proxy():
         web.wsgi_app = ReverseProxied(web.wsgi_app)
 
 
+def get_bot():
+    # the bot is chosen with ?bot=name, the first one is used by default
+    name = request.args.get('bot')
+    for bot in var.controls:
+        if bot.get_name() == name:
+            return bot
+    return var.controls[0]
+
+
 @web.route("/", methods=['GET', 'POST'])
 def index():
+    bot = get_bot()
     folder_path = var.music_folder
-    files = util.get_recursive_filelist_sorted(var.music_folder)
-    music_library = util.Dir(folder_path)
-    for file in files:
-        music_library.add_file(file)
+    music_library = get_library_tree()
+    files = music_library.get_files_recursively()
 
+    status = None
     if request.method == 'POST':
         print(request.form)
         if 'add_file' in request.form and ".." not in request.form['add_file']:
-            item = {'type': 'file',
-                    'path' : request.form['add_file'],
-                    'user' : 'Web'}
-            var.playlist.append(item)
+            bot.add_items([media.file.get_music(request.form['add_file'], 'Web')])
 
         elif ('add_folder' in request.form and ".." not in request.form['add_folder']) or ('add_folder_recursively' in request.form and ".." not in request.form['add_folder_recursively']):
             try:
@@ -88,79 +109,521 @@ def index():
                 files = music_library.get_files_recursively(folder)
             else:
                 files = music_library.get_files(folder)
-            files = list(map(lambda file: {'type':'file','path': os.path.join(folder, file), 'user':'Web'}, files))
+            files = [media.file.get_music(os.path.join(folder, file), 'Web') for file in files]
             print('Adding to playlist: ', files)
-            var.playlist.extend(files)
+            bot.add_items(files)
 
         elif 'add_url' in request.form:
-            var.playlist.append({'type':'url',
-                                'url': request.form['add_url'],
-                                'user': 'Web',
-                                'ready': 'validation'})
-            media.url.get_url_info()
-            var.playlist[-1]['ready'] = "no"
+            # resolved in the background, through the same admission as the commands
+            status, value = bot.add_url(request.form['add_url'], request.remote_addr)
 
         elif 'add_radio' in request.form:
-            var.playlist.append({'type': 'radio',
-                                'path': request.form['add_radio'],
-                                'user': "Web"})
+            bot.add_items([{'type': 'radio',
+                            'url': request.form['add_radio'],
+                            'user': "Web"}])
 
         elif 'delete_music' in request.form:
-            if len(var.playlist) >= request.form['delete_music']:
-                var.playlist.pop(request.form['delete_music'])
-        
+            try:
+                start = int(request.form['delete_music'])
+                end = int(request.form.get('delete_to') or start)
+            except ValueError:
+                pass
+            else:
+                bot.remove_items(start, end)
+
+        elif 'move_music' in request.form:
+            try:
+                bot.move_item(int(request.form['move_music']), int(request.form['move_to']))
+            except (KeyError, ValueError):
+                pass
+
         elif 'action' in request.form:
             action = request.form['action']
             if action == "randomize":
-                random.shuffle(var.playlist)
+                bot.shuffle()
+            elif action == "skip":
+                bot.skip()
+            elif action == "dedupe":
+                bot.dedupe()
+
+    response = make_response(render_template('index.html',
+                                             all_files=files,
+                                             music_library=music_library,
+                                             os=os,
+                                             playlist=bot.get_playlist(),
+                                             user=bot.get_username(),
+                                             bot_name=bot.get_name(),
+                                             bot_names=[b.get_name() for b in var.controls]))
+    if request.method == 'GET':
+        response.add_etag()
+        response.make_conditional(request)
+    elif status == 'banned':
+        response.status_code = 403
+    elif status in ('rate', 'busy'):
+        response.status_code = 429
+        if status == 'rate':
+            response.headers['Retry-After'] = str(value)
+    return response
+
+
+library_tree = None
+
+
+def get_library_tree():
+    # the tree is only fetched again (through the control socket when the
+    # web interface runs in its own process) when the library changed
+    global library_tree
+    version = var.library.get_version()
+    if library_tree is None or library_tree[0] != version:
+        library_tree = (version, var.library.get_tree())
+    return library_tree[1]
+
+
+@web.route("/api/state", methods=['GET'])
+def api_state():
+    # with ?version=n, long-polls: answers once the state differs from version n
+    bot = get_bot()
+    version = request.args.get('version', type=int)
+    if version is not None:
+        bot.wait_change(version, 15)
+    return jsonify(bot.get_state())
+
+
+class EventBroadcaster:
+    """Sends the changes of a bot's state to its event streams.
+
+    A single thread per bot waits for the changes and computes the delta,
+    which is queued for every stream. The number of streams is limited, as
+    each one holds a thread of the web server; clients refused long-poll
+    /api/state instead.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.state = None
+        t = threading.Thread(target=self.run, name='events')
+        t.daemon = True
+        t.start()
+
+    def subscribe(self, limit):
+        """Queue of the state changes, starting with the full state. None if
+        there are already limit subscribers."""
+        with self.lock:
+            if len(self.subscribers) >= limit:
+                return None
+            subscriber = queue.Queue()
+            if self.state:
+                subscriber.put(self.state)
+            self.subscribers.append(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def run(self):
+        version = None
+        while True:
+            try:
+                if version is not None:
+                    self.bot.wait_change(version, 15)
+                state = self.bot.get_state()
+            except Exception as e:
+                # the bot process went away
+                logging.error('Could not get the state of the bot: {}'.format(e))
+                time.sleep(5)
+                continue
+            if state['version'] == version:
+                continue
+            with self.lock:
+                delta = {k: v for k, v in state.items() if self.state is None or self.state.get(k) != v}
+                self.state = state
+                version = state['version']
+                for subscriber in self.subscribers:
+                    subscriber.put(delta)
+
+
+broadcasters = {}
+broadcasters_lock = threading.Lock()
+
+
+def get_broadcaster(bot):
+    with broadcasters_lock:
+        if bot.get_name() not in broadcasters:
+            broadcasters[bot.get_name()] = EventBroadcaster(bot)
+        return broadcasters[bot.get_name()]
+
+
+@web.route("/api/events", methods=['GET'])
+def api_events():
+    # Server-sent events: the full state first, then only the changed keys
+    broadcaster = get_broadcaster(get_bot())
+    subscriber = broadcaster.subscribe(var.config.getint('webinterface', 'event_streams'))
+    if subscriber is None:
+        return jsonify({'error': 'too many event streams'}), 503
+
+    def stream():
+        try:
+            while True:
+                try:
+                    delta = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # also lets the server notice the clients gone
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'id: {}\nevent: state\ndata: {}\n\n'.format(delta['version'], json.dumps(delta))
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+# Responses worth compressing (static files included), event streams and file
+# downloads are left alone
+compressible_types = ['text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json']
+
+
+@web.after_request
+def compress(response):
+    if not var.config.getboolean('webinterface', 'gzip', fallback=False):
+        return response
+    if response.status_code != 200 or response.mimetype not in compressible_types \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        return response
+    # static files are sent from a file wrapper, read it
+    response.direct_passthrough = False
+    response.set_data(gzip.compress(response.get_data(), 6))
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag:
+        # the compressed variant has its own tag, checked again against If-None-Match
+        response.set_etag(etag + '-gzip', weak)
+        response.make_conditional(request)
+    return response
+
+
+def serve(addr, port):
+    logging.info('Starting web interface on {}:{}'.format(addr, port))
+    if var.config.getboolean('webinterface', 'production'):
+        web.config['SEND_FILE_MAX_AGE_DEFAULT'] = var.config.getint('webinterface', 'static_max_age')
+        web.jinja_env.auto_reload = False
+        try:
+            import waitress
+        except ImportError:
+            logging.error('waitress is not installed, using the development server')
+        else:
+            waitress.serve(web, host=addr, port=port, threads=var.config.getint('webinterface', 'workers'),
+                           ident='botamusique')
+            return
+    web.run(port=port, host=addr, threaded=True)
 
-    return render_template('index.html',
-                           all_files=files,
-                           music_library=music_library,
-                           os=os,
-                           playlist=var.playlist,
-                           user=var.user)
 
+def run_process(config_files, address, authkey):
+    # Entry point of the web interface when it runs in its own process
+    var.config = settings.Settings(config_files)
+    if var.config.getint('bot', 'config_reload_interval') > 0:
+        settings.watch(var.config.getint('bot', 'config_reload_interval'))
+    var.music_folder = var.config.get('bot', 'music_folder')
+    var.is_proxified = var.config.getboolean("webinterface", "is_web_proxified")
+    logging.basicConfig(format='%(asctime)s: %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
-def upload():
-    file = request.files['file']
-    if not file:
-        return redirect("./", code=406)
+    var.controls, var.library = control.connect(address, authkey)
+    init_proxy()
+    serve(var.config.get("webinterface", "listening_addr"), var.config.getint("webinterface", "listening_port"))
 
-    filename = secure_filename(file.filename).strip()
-    if filename == '':
-        return redirect("./", code=406)
 
-    targetdir = request.form['targetdir'].strip()
+upload_chunk_size = 64 * 1024
+
+
+def get_storage_path(targetdir):
+    targetdir = targetdir.strip()
     if targetdir == '':
         targetdir = 'uploads/'
     elif '../' in targetdir:
-        return redirect("./", code=406)
+        return None
+    storagepath = os.path.abspath(os.path.join(var.music_folder, targetdir))
+    if not storagepath.startswith(var.music_folder):
+        return None
+    return storagepath
+
+
+def get_upload_folder():
+    folder = os.path.join(var.config.get('bot', 'tmp_folder'), 'botamusique_uploads')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def is_audio(data):
+    mime = magic.from_buffer(data, mime=True)
+    return 'audio' in mime or 'video' in mime or 'audio' in magic.from_buffer(data).lower()
+
+
+def is_zip(data):
+    return magic.from_buffer(data, mime=True) == 'application/zip'
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def write_stream(stream, f, limit, first_chunk_check=None):
+    # Copy the stream to f chunk by chunk, raises UploadTooLarge past limit
+    # bytes. The first chunk is sniffed with first_chunk_check, returns False
+    # if it is refused.
+    first = first_chunk_check is not None
+    written = 0
+    while True:
+        chunk = stream.read(min(upload_chunk_size, limit - written + 1))
+        if not chunk:
+            return True
+        written += len(chunk)
+        if written > limit:
+            raise UploadTooLarge()
+        if first and not first_chunk_check(chunk):
+            return False
+        first = False
+        f.write(chunk)
+
+
+def get_max_upload_size():
+    return var.config.getint('webinterface', 'max_upload_size') * 1024 * 1024
+
+
+def extract_zip(zippath, storagepath, name):
+    # Unpack the audio files of the archive under storagepath/name, returns
+    # their library paths. Raises UploadTooLarge, with nothing kept, if it
+    # unpacks to more than max_extracted_size or max_extracted_files.
+    max_size = var.config.getint('webinterface', 'max_extracted_size') * 1024 * 1024
+    max_files = var.config.getint('webinterface', 'max_extracted_files')
+    added = []
+    written = []
+    total = 0
+    try:
+        with zipfile.ZipFile(zippath) as archive:
+            infos = [info for info in archive.infolist() if not info.is_dir()]
+            # the sizes declared by the archive first, then the bytes actually written
+            if len(infos) > max_files or sum(info.file_size for info in infos) > max_size:
+                raise UploadTooLarge()
+            for info in infos:
+                parts = [secure_filename(part) for part in info.filename.split('/')]
+                if '' in parts:
+                    continue
+                filepath = os.path.join(storagepath, secure_filename(name), *parts)
+                if os.path.exists(filepath):
+                    continue
+                with archive.open(info) as src:
+                    head = src.read(upload_chunk_size)
+                    if not is_audio(head):
+                        continue
+                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                    with open(filepath, 'wb') as dst:
+                        written.append(filepath)
+                        dst.write(head)
+                        if total + len(head) > max_size:
+                            raise UploadTooLarge()
+                        write_stream(src, dst, max_size - total - len(head))
+                        total += dst.tell()
+                added.append(os.path.relpath(filepath, var.music_folder))
+    except UploadTooLarge:
+        for filepath in written:
+            os.remove(filepath)
+        raise
+    return added
+
+
+def finish_upload(partfile, storagepath, filename):
+    # Move the completed upload to the music folder and index it, returns the library paths added
+    os.makedirs(storagepath, exist_ok=True)
+    if filename.lower().endswith('.zip'):
+        try:
+            added = extract_zip(partfile, storagepath, filename[:-4])
+        finally:
+            os.remove(partfile)
+    else:
+        filepath = os.path.join(storagepath, filename)
+        if os.path.exists(filepath):
+            os.remove(partfile)
+            return []
+        shutil.move(partfile, filepath)
+        added = [os.path.relpath(filepath, var.music_folder)]
+    for file in added:
+        var.library.add_file(file)
+    return added
 
-    # print('Uploading file:')
-    # print('filename:', filename)
-    # print('targetdir:', targetdir)
-    # print('mimetype:', file.mimetype)
 
-    if "audio" in file.mimetype:
-        storagepath = os.path.abspath(os.path.join(var.music_folder, targetdir))
-        if not storagepath.startswith(var.music_folder):
-            return redirect("./", code=406)
+@web.route('/upload', methods=['POST'])
+def upload():
+    # Plain form upload, several files allowed. The size is checked before
+    # the form is parsed, which spools the files.
+    max_size = get_max_upload_size()
+    if request.content_length is None or request.content_length > max_size:
+        return redirect("./", code=413)
+    files = request.files.getlist('file')
+    if not files:
+        return redirect("./", code=406)
 
-        try:
-            os.makedirs(storagepath)
-        except OSError as ee:
-            if ee.errno != errno.EEXIST:
-                return redirect("./", code=500)
+    storagepath = get_storage_path(request.form.get('targetdir', ''))
+    if storagepath is None:
+        return redirect("./", code=406)
 
-        filepath = os.path.join(storagepath, filename)
-        if os.path.exists(filepath):
+    for file in files:
+        filename = secure_filename(file.filename).strip()
+        if filename == '':
             return redirect("./", code=406)
 
-        file.save(filepath)
-        return redirect("./", code=302)
-    else:
-        return redirect("./", code=409)
+        partfile = os.path.join(get_upload_folder(), uuid.uuid4().hex + '.part')
+        try:
+            with open(partfile, 'wb') as f:
+                accepted = write_stream(file.stream, f, max_size,
+                                        lambda data: is_audio(data) or (filename.lower().endswith('.zip') and is_zip(data)))
+        except UploadTooLarge:
+            os.remove(partfile)
+            return redirect("./", code=413)
+        if not accepted:
+            os.remove(partfile)
+            return redirect("./", code=409)
+        try:
+            finish_upload(partfile, storagepath, filename)
+        except UploadTooLarge:
+            return redirect("./", code=413)
+
+    return redirect("./", code=302)
+
+
+# Resumable upload API:
+#  POST /api/upload (filename, size, targetdir) -> {"id", "offset"}
+#  PUT /api/upload/<id> with a Content-Range header, the body is the chunk
+#  GET /api/upload/<id> -> {"offset"} to resume after an interruption
+upload_locks = {}  # upload id -> lock held while a chunk is written
+upload_locks_lock = threading.Lock()
+
+
+def get_upload(upload_id):
+    if not re.match(r'^[0-9a-f]{32}$', upload_id):
+        return None, None
+    folder = get_upload_folder()
+    try:
+        with open(os.path.join(folder, upload_id + '.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    return meta, os.path.join(folder, upload_id + '.part')
+
+
+def clean_uploads():
+    # forget uploads that were abandoned for a day
+    folder = get_upload_folder()
+    for file in os.listdir(folder):
+        path = os.path.join(folder, file)
+        if os.path.getmtime(path) < time.time() - 86400:
+            os.remove(path)
+
+
+@web.route('/api/upload', methods=['POST'])
+def api_upload_start():
+    filename = secure_filename(request.values.get('filename', '')).strip()
+    storagepath = get_storage_path(request.values.get('targetdir', ''))
+    try:
+        size = int(request.values.get('size', ''))
+    except ValueError:
+        size = -1
+    if filename == '' or storagepath is None or size <= 0:
+        return jsonify({'error': 'bad request'}), 400
+    if size > get_max_upload_size():
+        return jsonify({'error': 'file too large'}), 413
+    if not filename.lower().endswith('.zip') and os.path.exists(os.path.join(storagepath, filename)):
+        return jsonify({'error': 'file exists'}), 409
+
+    clean_uploads()
+    upload_id = uuid.uuid4().hex
+    folder = get_upload_folder()
+    with open(os.path.join(folder, upload_id + '.json'), 'w') as f:
+        json.dump({'filename': filename, 'storagepath': storagepath, 'size': size}, f)
+    open(os.path.join(folder, upload_id + '.part'), 'wb').close()
+    return jsonify({'id': upload_id, 'offset': 0})
+
+
+@web.route('/api/upload/<upload_id>', methods=['GET'])
+def api_upload_status(upload_id):
+    meta, partfile = get_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'unknown upload'}), 404
+    return jsonify({'id': upload_id, 'offset': os.path.getsize(partfile), 'size': meta['size']})
+
+
+@web.route('/api/upload/<upload_id>', methods=['PUT'])
+def api_upload_chunk(upload_id):
+    meta, partfile = get_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'unknown upload'}), 404
+
+    # one chunk of an upload at a time, a concurrent one resumes from the offset
+    with upload_locks_lock:
+        lock = upload_locks.setdefault(upload_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return jsonify({'error': 'upload in progress', 'offset': os.path.getsize(partfile)}), 409
+    try:
+        return write_chunk(upload_id, meta, partfile)
+    finally:
+        lock.release()
+
+
+def write_chunk(upload_id, meta, partfile):
+    try:
+        offset = os.path.getsize(partfile)
+    except OSError:
+        # finished or cancelled meanwhile
+        return jsonify({'error': 'unknown upload'}), 404
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if content_range is None or content_range.start != offset or content_range.length != meta['size']:
+        # the client resumes from the offset we have
+        return jsonify({'error': 'bad range', 'offset': offset}), 409
+    length = content_range.stop - content_range.start
+    if request.content_length is None:
+        return jsonify({'error': 'length required', 'offset': offset}), 411
+    if request.content_length != length:
+        return jsonify({'error': 'bad length', 'offset': offset}), 400
+
+    filename = meta['filename']
+    check = None
+    if offset == 0:
+        check = lambda data: is_audio(data) or (filename.lower().endswith('.zip') and is_zip(data))
+    try:
+        with open(partfile, 'ab') as f:
+            accepted = write_stream(request.stream, f, length, check)
+    except UploadTooLarge:
+        with open(partfile, 'ab') as f:
+            f.truncate(offset)
+        return jsonify({'error': 'too much data', 'offset': offset}), 409
+    if not accepted:
+        remove_upload(upload_id, partfile)
+        return jsonify({'error': 'not an audio file'}), 415
+
+    offset = os.path.getsize(partfile)
+    if offset < meta['size']:
+        return jsonify({'id': upload_id, 'offset': offset})
+
+    remove_upload(upload_id)
+    try:
+        files = finish_upload(partfile, meta['storagepath'], filename)
+    except UploadTooLarge:
+        return jsonify({'error': 'archive too large'}), 413
+    return jsonify({'id': upload_id, 'offset': offset, 'done': True, 'files': files})
+
+
+def remove_upload(upload_id, partfile=None):
+    os.remove(os.path.join(get_upload_folder(), upload_id + '.json'))
+    if partfile:
+        os.remove(partfile)
+    with upload_locks_lock:
+        upload_locks.pop(upload_id, None)
 
 
 @web.route('/download', methods=["GET"])
@@ -169,7 +632,7 @@ def download():
         requested_file = request.args['file']
         if '../' not in requested_file:
             folder_path = var.music_folder
-            files = util.get_recursive_filelist_sorted(var.music_folder)
+            files = var.library.get_files()
 
             if requested_file in files:
                 filepath = os.path.join(folder_path, requested_file)
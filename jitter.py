@@ -0,0 +1,82 @@
+import logging
+import time
+import metrics
+
+
+class AdaptiveBuffer:
+    """Target fill level (in seconds) of the pymumble output buffer.
+
+    The target grows quickly when the decoder stalls or the output buffer
+    runs dry, and slowly shrinks back towards `min_size` while delivery is
+    steady, so that skip/volume stay snappy when the source is reliable.
+    """
+
+    # how much headroom to keep above the worst recent decoder stall
+    safety = 1.5
+    # stall peak decay per second, and target decay per second when stable
+    peak_decay = 0.9
+    target_decay = 0.97
+    # multiplicative/additive raise after an underrun
+    underrun_factor = 1.5
+    underrun_step = 0.05
+
+    def __init__(self, min_size=0.1, max_size=2.0, name='buffer'):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.name = name
+        self.target = min_size
+        self.jitter = 0.0
+        self.peak_stall = 0.0
+        self.underruns = 0
+        self.primed = False
+        self.last_update = time.time()
+        self._publish()
+
+    def reset(self):
+        # a new track starts, an empty buffer is expected until it fills up
+        self.primed = False
+
+    def delivered(self, duration, elapsed):
+        """A chunk of `duration` seconds of audio took `elapsed` seconds to decode."""
+        stall = max(0.0, elapsed - duration)
+        self.jitter += (stall - self.jitter) / 16
+        if stall > self.peak_stall:
+            self.peak_stall = stall
+            floor = min(self.max_size, self.peak_stall * self.safety)
+            if floor > self.target:
+                logging.debug('{}: decoder stalled {:.3f}s, raising target to {:.3f}s'.format(self.name, stall, floor))
+                self.target = floor
+                metrics.incr(self.name + '.raised')
+        self._publish()
+
+    def observe(self, buffered):
+        """Called by the audio loop with the current output buffer size in seconds."""
+        now = time.time()
+        elapsed = now - self.last_update
+        self.last_update = now
+
+        if buffered >= self.target:
+            self.primed = True
+        elif buffered <= 0 and self.primed:
+            self.primed = False
+            self.underruns += 1
+            self.target = min(self.max_size, self.target * self.underrun_factor + self.underrun_step)
+            logging.debug('{}: underrun, raising target to {:.3f}s'.format(self.name, self.target))
+            metrics.incr(self.name + '.underruns')
+            metrics.incr(self.name + '.raised')
+            self._publish()
+            return
+
+        if elapsed > 0:
+            self.peak_stall *= self.peak_decay ** elapsed
+            floor = max(self.min_size, self.peak_stall * self.safety)
+            if self.target > floor:
+                self.target = max(floor, self.target * self.target_decay ** elapsed)
+                if self.target == floor:
+                    metrics.incr(self.name + '.lowered')
+        self._publish()
+
+    def _publish(self):
+        metrics.gauge(self.name + '.target', self.target)
+        metrics.gauge(self.name + '.jitter', self.jitter)
+        metrics.gauge(self.name + '.peak_stall', self.peak_stall)
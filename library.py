@@ -0,0 +1,255 @@
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+from types import MappingProxyType
+import util
+
+
+class LibraryTree:
+    """Immutable tree of the library files, built from the sorted file list.
+
+    Path components are interned, lookups walk one node per component, and
+    recursive listings are computed once per node. Adding a file returns a new
+    tree sharing the unchanged nodes.
+    """
+
+    __slots__ = ('name', 'path', 'subdirs', 'files', '_files_recursively', '_subdirs_recursively')
+
+    def __init__(self, name, path, subdirs, files):
+        self.name = name
+        self.path = path
+        self.subdirs = MappingProxyType(subdirs)
+        self.files = tuple(files)
+        self._files_recursively = None
+        self._subdirs_recursively = None
+
+    @classmethod
+    def build(cls, files, name='', path=''):
+        children = {}
+        own_files = []
+        for file in files:
+            if '/' in file:
+                subdir, rest = file.split('/', 1)
+                children.setdefault(sys.intern(subdir), []).append(rest)
+            else:
+                own_files.append(sys.intern(file))
+        subdirs = {subdir: cls.build(subfiles, subdir, path + subdir + '/')
+                   for subdir, subfiles in sorted(children.items())}
+        return cls(name, path, subdirs, own_files)
+
+    def __reduce__(self):
+        # sent to the web interface process as a file list
+        return LibraryTree.build, (self.get_files_recursively(), self.name, self.path)
+
+    def with_file(self, file):
+        if '/' in file:
+            subdir, rest = file.split('/', 1)
+            subdir = sys.intern(subdir)
+            subdirs = dict(self.subdirs)
+            if subdir in subdirs:
+                subdirs[subdir] = subdirs[subdir].with_file(rest)
+            else:
+                subdirs[subdir] = LibraryTree.build([rest], subdir, self.path + subdir + '/')
+            subdirs = dict(sorted(subdirs.items()))
+            return LibraryTree(self.name, self.path, subdirs, self.files)
+        if file in self.files:
+            return self
+        files = list(self.files)
+        bisect.insort(files, sys.intern(file))
+        return LibraryTree(self.name, self.path, dict(self.subdirs), files)
+
+    def find(self, path=None):
+        """Node of a directory relative to this one, None if there is none."""
+        node = self
+        for component in (path or '').split('/'):
+            if component in ('', '.'):
+                continue
+            node = node.subdirs.get(component)
+            if node is None:
+                return None
+        return node
+
+    def get_subdirs(self, path=None):
+        node = self.find(path)
+        return node.subdirs if node else MappingProxyType({})
+
+    def get_files(self, path=None):
+        node = self.find(path)
+        return node.files if node else ()
+
+    def get_files_recursively(self, path=None):
+        node = self.find(path)
+        if node is None:
+            return ()
+        if node._files_recursively is None:
+            files = [subdir + '/' + file for subdir, subnode in node.subdirs.items()
+                     for file in subnode.get_files_recursively()]
+            node._files_recursively = tuple(sorted(files + list(node.files)))
+        return node._files_recursively
+
+    def get_subdirs_recursively(self, path=None):
+        node = self.find(path)
+        if node is None:
+            return ()
+        if node._subdirs_recursively is None:
+            subdirs = []
+            for subdir, subnode in node.subdirs.items():
+                subdirs.append(subdir)
+                subdirs.extend(subdir + '/' + d for d in subnode.get_subdirs_recursively())
+            node._subdirs_recursively = tuple(subdirs)
+        return node._subdirs_recursively
+
+
+class LibraryIndex:
+    """Index of the audio files of the music folder, shared by every bot of the process.
+
+    Besides the file list, the index stores metadata about tracks (library
+    files keyed by their relative path, URL tracks keyed by their URL), which
+    is persisted in `index_file`.
+    """
+
+    def __init__(self, folder, index_file=None):
+        self.folder = folder
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.files = None  # tuple, replaced as a whole since callers iterate it unlocked
+        self.scanning = None  # Event set when the scan in progress ends
+        self.tree = None
+        self.version = 0
+        self.meta = {}
+        self.listeners = []
+        self.load()
+
+    def get_files(self):
+        # The scan runs outside the lock, which also guards the metadata;
+        # callers arriving meanwhile wait for it instead of scanning again.
+        with self.lock:
+            if self.files is not None:
+                return self.files
+            running = self.scanning
+            if running is None:
+                scanning = self.scanning = threading.Event()
+        if running is not None:
+            running.wait()
+            return self.get_files()
+
+        try:
+            logging.info('Scanning music library ' + self.folder)
+            files = tuple(util.get_recursive_filelist_sorted(self.folder))
+            with self.lock:
+                self.files = files
+                self.tree = None
+                self.version += 1
+        finally:
+            with self.lock:
+                self.scanning = None
+            scanning.set()
+        for listener in self.listeners:
+            listener(files)
+        return files
+
+    def wait_scan(self):
+        with self.lock:
+            scanning = self.scanning
+        if scanning is not None:
+            scanning.wait()
+
+    def refresh(self):
+        # a scan already running may have missed the latest changes
+        self.wait_scan()
+        with self.lock:
+            self.files = None
+        return self.get_files()
+
+    def add_file(self, path):
+        """Insert a new file without rescanning the library."""
+        with self.lock:
+            if self.files is None:
+                return
+            index = bisect.bisect_left(self.files, path)
+            if index < len(self.files) and self.files[index] == path:
+                return
+            self.files = self.files[:index] + (path,) + self.files[index:]
+            if self.tree is not None:
+                self.tree = self.tree.with_file(path)
+            self.version += 1
+        for listener in self.listeners:
+            listener([path])
+
+    def get_version(self):
+        """Changes each time the file list changes."""
+        return self.version
+
+    def get_tree(self):
+        self.get_files()
+        with self.lock:
+            if self.tree is not None:
+                return self.tree
+            files, version = self.files, self.version
+        tree = LibraryTree.build(files)
+        with self.lock:
+            if self.version == version:
+                self.tree = tree
+        return tree
+
+    def add_listener(self, listener):
+        """`listener(files)` is called with the file list after each scan."""
+        self.listeners.append(listener)
+
+    def get_meta(self, key):
+        with self.lock:
+            return dict(self.meta.get(key, {}))
+
+    def set_meta(self, key, **values):
+        with self.lock:
+            self.meta.setdefault(key, {}).update(values)
+
+    def get_file_meta(self, path):
+        """Metadata of a library file, empty if the file changed since it was stored."""
+        meta = self.get_meta(path)
+        try:
+            if meta and meta.get('mtime') != os.path.getmtime(os.path.join(self.folder, path)):
+                return {}
+        except OSError:
+            return {}
+        return meta
+
+    def set_file_meta(self, path, **values):
+        try:
+            values['mtime'] = os.path.getmtime(os.path.join(self.folder, path))
+        except OSError:
+            return
+        with self.lock:
+            meta = self.meta.get(path)
+            if meta is None or meta.get('mtime') != values['mtime']:
+                meta = self.meta[path] = {}
+            meta.update(values)
+
+    def load(self):
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+            self.meta = data.get('meta', {})
+        except (OSError, ValueError) as e:
+            logging.error('Could not read library index {}: {}'.format(self.index_file, e))
+
+    def save(self):
+        if not self.index_file:
+            return
+        with self.lock:
+            data = json.dumps({'meta': self.meta})
+        # the workers and the bots save concurrently, they share the tmp file
+        with self.save_lock:
+            tmpfile = self.index_file + '.tmp'
+            try:
+                with open(tmpfile, 'w') as f:
+                    f.write(data)
+                os.replace(tmpfile, self.index_file)
+            except OSError as e:
+                logging.error('Could not write library index {}: {}'.format(self.index_file, e))
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import configparser
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import struct
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+import wave
+from pymumble.pymumble_py3 import mumble_pb2
+from pymumble.pymumble_py3.constants import PYMUMBLE_AUDIO_TYPE_OPUS, PYMUMBLE_SEQUENCE_DURATION, \
+    PYMUMBLE_MSG_TYPES_VERSION, PYMUMBLE_MSG_TYPES_UDPTUNNEL, PYMUMBLE_MSG_TYPES_AUTHENTICATE, \
+    PYMUMBLE_MSG_TYPES_PING, PYMUMBLE_MSG_TYPES_SERVERSYNC, PYMUMBLE_MSG_TYPES_CHANNELSTATE, \
+    PYMUMBLE_MSG_TYPES_USERSTATE, PYMUMBLE_MSG_TYPES_TEXTMESSAGE, PYMUMBLE_MSG_TYPES_CODECVERSION, \
+    PYMUMBLE_MSG_TYPES_SERVERCONFIG
+
+# Offline load test of the bot. mumbleBot.py is started against a local
+# stand-in for murmur, speaking enough of the protocol for pymumble (TLS,
+# authentication, channel and user states, text messages, pings and audio
+# tunneled over TCP). Fake users in the bot's channel send it commands, each
+# waiting for the reply before the next one, while the bot plays a generated
+# tone. Reported: command latency, the cadence of the audio packets, and the
+# CPU used by the bot and its ffmpeg processes per second of audio played.
+#
+#   ./loadtest.py --users 20 --duration 60 --set bot.message_rate=10
+
+default_commands = ['!np', '!queue', '!list', '!v', '!v 40', '!file tone.wav']
+
+BOT_SESSION = 1
+
+
+def read_varint(data, pos):
+    """Mumble varint at data[pos], returns (value, position after it)."""
+    b = data[pos]
+    if b & 0x80 == 0:
+        return b, pos + 1
+    if b & 0xC0 == 0x80:
+        return (b & 0x3F) << 8 | data[pos + 1], pos + 2
+    if b & 0xE0 == 0xC0:
+        return (b & 0x1F) << 16 | data[pos + 1] << 8 | data[pos + 2], pos + 3
+    if b & 0xF0 == 0xE0:
+        return (b & 0x0F) << 24 | data[pos + 1] << 16 | data[pos + 2] << 8 | data[pos + 3], pos + 4
+    if b & 0xFC == 0xF0:
+        return struct.unpack('!I', data[pos + 1:pos + 5])[0], pos + 5
+    if b & 0xFC == 0xF4:
+        return struct.unpack('!Q', data[pos + 1:pos + 9])[0], pos + 9
+    raise ValueError('Unsupported varint {:#x}'.format(b))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class FakeServer:
+    """Stand-in for murmur, accepting a single client: the bot.
+
+    The fake users exist only as user states sent to the bot; their messages
+    are written on the bot's connection as if the server relayed them.
+    """
+
+    def __init__(self, certfile, users, bandwidth=72000, message_length=5000):
+        self.users = users  # session -> name
+        self.bandwidth = bandwidth
+        self.message_length = message_length
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()  # the bot is synchronized and set its comment
+        self.closed = threading.Event()
+        self.on_text = None
+        self.on_audio = None
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='server')
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        conn, addr = self.listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.conn = self.context.wrap_socket(conn, server_side=True)
+            while True:
+                type, length = struct.unpack('!HL', self.recv_exact(6))
+                self.handle(type, self.recv_exact(length))
+        except (OSError, EOFError) as e:
+            if not self.closed.is_set():
+                print('Connection closed: {}'.format(e))
+        finally:
+            self.closed.set()
+
+    def recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError('the bot disconnected')
+            data += chunk
+        return data
+
+    def send(self, type, message):
+        data = message.SerializeToString()
+        with self.send_lock:
+            self.conn.sendall(struct.pack('!HL', type, len(data)) + data)
+
+    def handle(self, type, data):
+        if type == PYMUMBLE_MSG_TYPES_AUTHENTICATE:
+            self.handshake()
+        elif type == PYMUMBLE_MSG_TYPES_PING:
+            ping = mumble_pb2.Ping()
+            ping.ParseFromString(data)
+            self.send(PYMUMBLE_MSG_TYPES_PING, mumble_pb2.Ping(timestamp=ping.timestamp))
+        elif type == PYMUMBLE_MSG_TYPES_USERSTATE:
+            # accept every change (comment, mute, moves) and echo it like murmur
+            state = mumble_pb2.UserState()
+            state.ParseFromString(data)
+            if not state.HasField('session'):
+                state.session = BOT_SESSION
+            state.actor = BOT_SESSION
+            self.send(PYMUMBLE_MSG_TYPES_USERSTATE, state)
+            self.ready.set()
+        elif type == PYMUMBLE_MSG_TYPES_TEXTMESSAGE:
+            message = mumble_pb2.TextMessage()
+            message.ParseFromString(data)
+            if self.on_text:
+                self.on_text(message)
+        elif type == PYMUMBLE_MSG_TYPES_UDPTUNNEL:
+            if self.on_audio:
+                self.on_audio(data)
+
+    def handshake(self):
+        self.send(PYMUMBLE_MSG_TYPES_VERSION, mumble_pb2.Version(version=(1 << 16) | (3 << 8), release='loadtest',
+                                                                  os='', os_version=''))
+        self.send(PYMUMBLE_MSG_TYPES_CODECVERSION, mumble_pb2.CodecVersion(alpha=-2147483637, beta=0,
+                                                                           prefer_alpha=True, opus=True))
+        self.send(PYMUMBLE_MSG_TYPES_CHANNELSTATE, mumble_pb2.ChannelState(channel_id=0, name='Root'))
+        self.send(PYMUMBLE_MSG_TYPES_USERSTATE, mumble_pb2.UserState(session=BOT_SESSION, name='botamusique',
+                                                                     channel_id=0))
+        for session, name in self.users.items():
+            self.send(PYMUMBLE_MSG_TYPES_USERSTATE, mumble_pb2.UserState(session=session, name=name, channel_id=0))
+        self.send(PYMUMBLE_MSG_TYPES_SERVERSYNC, mumble_pb2.ServerSync(session=BOT_SESSION, max_bandwidth=self.bandwidth,
+                                                                       welcome_text='', permissions=0))
+        self.send(PYMUMBLE_MSG_TYPES_SERVERCONFIG, mumble_pb2.ServerConfig(max_bandwidth=self.bandwidth,
+                                                                           allow_html=True,
+                                                                           message_length=self.message_length,
+                                                                           image_message_length=self.message_length * 10))
+
+    def send_text(self, session, message):
+        self.send(PYMUMBLE_MSG_TYPES_TEXTMESSAGE, mumble_pb2.TextMessage(actor=session, session=[BOT_SESSION],
+                                                                         message=message))
+
+
+class Recorder:
+    """Replies and audio packets received from the bot.
+
+    Each fake user waits for a reply to its command: a private message to the
+    user answers it, a channel message answers the oldest waiting command.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = {}  # session -> time its command was sent
+        self.latencies = []
+        self.timeouts = 0
+        self.messages = 0
+        self.audio = []  # (arrival time, sequence)
+
+    def reset(self):
+        with self.cond:
+            self.latencies = []
+            self.timeouts = 0
+            self.messages = 0
+
+    def command_sent(self, session):
+        with self.cond:
+            self.waiting[session] = time.time()
+
+    def wait_reply(self, session, timeout):
+        with self.cond:
+            if not self.cond.wait_for(lambda: session not in self.waiting, timeout):
+                del self.waiting[session]
+                self.timeouts += 1
+
+    def text_received(self, message):
+        now = time.time()
+        with self.cond:
+            self.messages += 1
+            if message.session:
+                sessions = [session for session in message.session if session in self.waiting]
+            elif self.waiting:
+                sessions = [min(self.waiting, key=self.waiting.get)]
+            else:
+                sessions = []
+            for session in sessions:
+                self.latencies.append(now - self.waiting.pop(session))
+            self.cond.notify_all()
+
+    def audio_received(self, packet):
+        now = time.time()
+        if packet[0] >> 5 != PYMUMBLE_AUDIO_TYPE_OPUS:
+            return
+        sequence, pos = read_varint(packet, 1)
+        with self.cond:
+            self.audio.append((now, sequence))
+            self.cond.notify_all()
+
+
+class CpuSampler:
+    """CPU time of a process and its descendants, read from /proc.
+
+    Processes are sampled periodically, so the time of a child exiting
+    between two samples is counted up to the last sample only.
+    """
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.tick = os.sysconf('SC_CLK_TCK')
+        self.lock = threading.Lock()
+        self.times = {}  # pid -> cpu seconds at the last sample
+        self.stopped = False
+        t = threading.Thread(target=self.run, name='cpu')
+        t.daemon = True
+        t.start()
+
+    def read_stat(self, pid):
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the process name may contain spaces, the fields start after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[1]), (int(fields[11]) + int(fields[12])) / self.tick
+
+    def sample(self):
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    stats[int(entry)] = self.read_stat(entry)
+                except (OSError, IndexError, ValueError):
+                    pass
+        children = collections.defaultdict(list)
+        for pid, (ppid, cpu) in stats.items():
+            children[ppid].append(pid)
+        pids = [self.pid]
+        with self.lock:
+            while pids:
+                pid = pids.pop()
+                if pid in stats:
+                    self.times[pid] = stats[pid][1]
+                pids.extend(children[pid])
+
+    def run(self):
+        while not self.stopped:
+            self.sample()
+            time.sleep(self.interval)
+
+    def get(self):
+        """(CPU seconds of the process, CPU seconds of its descendants)"""
+        self.sample()
+        with self.lock:
+            return self.times.get(self.pid, 0), sum(cpu for pid, cpu in self.times.items() if pid != self.pid)
+
+
+def write_tone(path, duration):
+    # a 440 Hz tone with a slow tremolo, 44.1 kHz mono, so that it is resampled like most files
+    rate = 44100
+    second = struct.pack('<{}h'.format(rate), *(int(12000 * (0.6 + 0.4 * math.sin(2 * math.pi * i / rate)) *
+                                                     math.sin(2 * math.pi * 440 * i / rate)) for i in range(rate)))
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        for i in range(int(math.ceil(duration))):
+            f.writeframes(second)
+
+
+def write_config(folder, overrides):
+    config = configparser.ConfigParser(interpolation=None)
+    config['bot'] = {'music_folder': os.path.join(folder, 'music') + '/',
+                     'tmp_folder': os.path.join(folder, 'tmp') + '/',
+                     'sfx_folder': os.path.join(folder, 'music') + '/',
+                     'soundfont_folder': os.path.join(folder, 'music') + '/',
+                     'library_index': os.path.join(folder, 'library.json'),
+                     'midi_cache_folder': os.path.join(folder, 'midi') + '/',
+                     'logfile': os.path.join(folder, 'bot.log'),
+                     'admin': 'user0',
+                     'config_reload_interval': '0'}
+    config['webinterface'] = {'enabled': 'False'}
+    for override in overrides:
+        option, value = override.split('=', 1)
+        section, option = option.split('.', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    path = os.path.join(folder, 'configuration.ini')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def run_user(server, recorder, session, commands, interval, timeout, end):
+    rnd = random.Random(session)
+    while time.time() < end and not server.closed.is_set():
+        recorder.command_sent(session)
+        server.send_text(session, rnd.choice(commands))
+        recorder.wait_reply(session, timeout)
+        time.sleep(rnd.uniform(0, 2 * interval))
+
+
+def report_latency(recorder):
+    latencies = recorder.latencies
+    print('Commands: {} answered, {} without reply, {} messages from the bot'.format(
+        len(latencies), recorder.timeouts, recorder.messages))
+    if latencies:
+        print('  latency: mean {:.0f} ms, p50 {:.0f} ms, p95 {:.0f} ms, p99 {:.0f} ms, max {:.0f} ms'.format(
+            1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 95), 1000 * percentile(latencies, 99), 1000 * max(latencies)))
+
+
+def report_audio(packets):
+    """Print the audio packet statistics, returns the seconds of audio played."""
+    if len(packets) < 2:
+        print('Audio: {} packets'.format(len(packets)))
+        return 0
+    deltas = [s1 - s0 for (t0, s0), (t1, s1) in zip(packets, packets[1:])]
+    # sequence numbers count 10 ms units, the usual step is the packet duration
+    step = collections.Counter(d for d in deltas if d > 0).most_common(1)[0][0]
+    duration = step * PYMUMBLE_SEQUENCE_DURATION
+    intervals = []
+    errors = []
+    dropouts = 0
+    dropout_time = 0
+    for ((t0, s0), (t1, s1)), delta in zip(zip(packets, packets[1:]), deltas):
+        if delta == step:
+            intervals.append(t1 - t0)
+            errors.append(abs(t1 - t0 - duration))
+        elif delta > step:
+            # pymumble moved the sequence forward over a gap in the audio
+            dropouts += 1
+            dropout_time += (delta - step) * PYMUMBLE_SEQUENCE_DURATION
+    played = len(packets) * duration
+    print('Audio: {} packets of {:.0f} ms, {:.1f} s played, {} dropouts ({:.2f} s)'.format(
+        len(packets), 1000 * duration, played, dropouts, dropout_time))
+    if intervals:
+        print('  interval: mean {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+            1000 * sum(intervals) / len(intervals), 1000 * percentile(intervals, 50),
+            1000 * percentile(intervals, 95), 1000 * percentile(intervals, 99), 1000 * max(intervals)))
+        print('  jitter: mean {:.1f} ms, p99 {:.1f} ms'.format(
+            1000 * sum(errors) / len(errors), 1000 * percentile(errors, 99)))
+    return played
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bot against a local fake Mumble server')
+    parser.add_argument('--users', type=int, default=10, help='Number of fake users sending commands. Default: 10')
+    parser.add_argument('--duration', type=float, default=30, help='Duration of the test in seconds. Default: 30')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Mean time (in seconds) a user waits between a reply and its next command. Default: 1')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='Time (in seconds) a user waits for a reply. Default: 10')
+    parser.add_argument('--commands', type=str, help='File of commands sent by the users, one per line')
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='SECTION.OPTION=VALUE',
+                        help='Configuration option of the bot, can be repeated')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder (configuration, bot log)')
+    args = parser.parse_args()
+
+    commands = default_commands
+    if args.commands:
+        with open(args.commands) as f:
+            commands = [line.strip() for line in f if line.strip()]
+
+    folder = tempfile.mkdtemp(prefix='botamusique_loadtest_')
+    for name in ['music', 'tmp', 'midi']:
+        os.mkdir(os.path.join(folder, name))
+    write_tone(os.path.join(folder, 'music', 'tone.wav'), args.duration + 30)
+    config = write_config(folder, args.overrides)
+    certfile = os.path.join(folder, 'server.pem')
+    sp.check_call(['openssl', 'req', '-x509', '-nodes', '-days', '1', '-newkey', 'rsa:2048', '-keyout', certfile,
+                   '-out', certfile, '-subj', '/CN=localhost'], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+    recorder = Recorder()
+    server = FakeServer(certfile, {BOT_SESSION + 1 + i: 'user{}'.format(i) for i in range(args.users)})
+    server.on_text = recorder.text_received
+    server.on_audio = recorder.audio_received
+    server.start()
+
+    bot_dir = os.path.dirname(os.path.abspath(__file__))
+    bot = sp.Popen([sys.executable, os.path.join(bot_dir, 'mumbleBot.py'), '--config', config,
+                    '--db', os.path.join(folder, 'db.ini'), '-s', '127.0.0.1', '-p', str(server.port)],
+                   cwd=bot_dir, start_new_session=True)
+    cpu = CpuSampler(bot.pid)
+    try:
+        start = time.time()
+        if not server.ready.wait(60):
+            print('The bot did not connect, see {}'.format(os.path.join(folder, 'bot.log')))
+            args.keep = True
+            return 1
+        print('Bot connected in {:.2f} s'.format(time.time() - start))
+
+        # user0 starts the music, the test begins with the first audio packet
+        recorder.command_sent(BOT_SESSION + 1)
+        server.send_text(BOT_SESSION + 1, '!file tone.wav')
+        recorder.wait_reply(BOT_SESSION + 1, args.timeout)
+        with recorder.cond:
+            if not recorder.cond.wait_for(lambda: recorder.audio, 30):
+                print('The bot did not play, see {}'.format(os.path.join(folder, 'bot.log')))
+                args.keep = True
+                return 1
+            recorder.audio = []
+        recorder.reset()
+
+        print('{} users for {:.0f} s...'.format(args.users, args.duration))
+        cpu_start = cpu.get()
+        end = time.time() + args.duration
+        threads = []
+        for session in server.users:
+            t = threading.Thread(target=run_user, args=(server, recorder, session, commands, args.interval,
+                                                        args.timeout, end))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        cpu_end = cpu.get()
+        with recorder.cond:
+            packets = [packet for packet in recorder.audio if packet[0] <= end]
+        if server.closed.is_set():
+            print('The bot disconnected during the test, see {}'.format(os.path.join(folder, 'bot.log')))
+            args.keep = True
+
+        report_latency(recorder)
+        played = report_audio(packets)
+        bot_cpu = cpu_end[0] - cpu_start[0]
+        children_cpu = cpu_end[1] - cpu_start[1]
+        print('CPU: {:.2f} s bot, {:.2f} s child processes'.format(bot_cpu, children_cpu))
+        if played:
+            print('  per played second: {:.1f} ms bot, {:.1f} ms child processes'.format(
+                1000 * bot_cpu / played, 1000 * children_cpu / played))
+        return 0
+    finally:
+        cpu.stopped = True
+        try:
+            os.killpg(bot.pid, signal.SIGTERM)
+            bot.wait(10)
+        except ProcessLookupError:
+            pass
+        except sp.TimeoutExpired:
+            os.killpg(bot.pid, signal.SIGKILL)
+        server.closed.set()
+        if args.keep:
+            print('Files kept in {}'.format(folder))
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import audioop
+import logging
+import multiprocessing
+import multiprocessing.forkserver
+import signal
+import subprocess as sp
+import sys
+from multiprocessing import shared_memory
+import metrics
+
+# Decoding out of the bot's process: a worker process runs the decoder
+# (ffmpeg), downmixes and scales its output, and writes 20 ms frames into a
+# ring of slots in shared memory. The bot only copies finished frames from
+# the ring, so the decoding work doesn't compete for its GIL with pymumble and
+# the web interface. Workers are forked from a forkserver (the bot's threads
+# make a plain fork unsafe), and restarted where the track was if they die.
+#
+# Ring layout: int32 length of each slot (in samples, 0 marking the end of the
+# track), float32 gain each slot was scaled with, then the slots of
+# FRAME_SIZE mono samples. `free` and `filled` count the slots of each kind.
+
+FRAME_SIZE = 960  # samples, 20 ms at 48 kHz
+FRAME_BYTES = FRAME_SIZE * 2
+
+_context = None
+
+
+def get_context():
+    global _context
+    if _context is None:
+        _context = multiprocessing.get_context('forkserver')
+    return _context
+
+
+def warm_up():
+    # the forkserver imports the bot's modules once, workers are forked from it
+    get_context()
+    multiprocessing.forkserver.ensure_running()
+
+
+def run_decoder(command, shm_name, slots, free, filled, gain):
+    """Worker process: the decoder's stereo output, downmixed and scaled, into the ring."""
+    # stopped by the bot with SIGTERM, ctrl-c is for the bot
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    lengths = shm.buf[:slots * 4].cast('i')
+    gains = shm.buf[slots * 4:slots * 8].cast('f')
+    frames = shm.buf[slots * 8:]
+    process = sp.Popen(command, stdout=sp.PIPE)
+    try:
+        slot = 0
+        while True:
+            data = process.stdout.read(FRAME_BYTES * 2)
+            data = data[:len(data) // 4 * 4]
+            if not data and process.wait() != 0:
+                # the decoder failed, the bot restarts the worker
+                sys.exit(1)
+            free.acquire()
+            if not data:
+                lengths[slot] = 0
+                filled.release()
+                break
+            value = gain.value
+            data = audioop.tomono(data, 2, value / 2, value / 2)
+            frames[slot * FRAME_BYTES:slot * FRAME_BYTES + len(data)] = data
+            lengths[slot] = len(data) // 2
+            gains[slot] = value
+            filled.release()
+            slot = (slot + 1) % slots
+    finally:
+        process.kill()
+        process.wait()
+        del lengths, gains, frames
+        shm.close()
+
+
+class Decoder:
+    """A decoder running in a supervised worker process.
+
+    get_command(position) returns the decoder command starting `position`
+    seconds into the track (position is always 0 if not seekable).
+    """
+
+    def __init__(self, get_command, gain=1.0, slots=10, max_restarts=3, seekable=True):
+        context = get_context()
+        self.get_command = get_command
+        self.slots = max(2, slots)
+        self.max_restarts = max_restarts
+        self.seekable = seekable
+        self.restarts = 0
+        self.position = 0  # seconds of audio read from the ring
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * (8 + FRAME_BYTES))
+        self.lengths = self.shm.buf[:self.slots * 4].cast('i')
+        self.gains = self.shm.buf[self.slots * 4:self.slots * 8].cast('f')
+        self.frames = self.shm.buf[self.slots * 8:]
+        self.gain = context.Value('d', gain, lock=False)
+        self.process = None
+        self.start()
+
+    def start(self):
+        context = get_context()
+        self.slot = 0
+        self.free = context.Semaphore(self.slots)
+        self.filled = context.Semaphore(0)
+        command = self.get_command(self.position if self.seekable else 0)
+        self.process = context.Process(target=run_decoder, name='decoder',
+                                       args=(command, self.shm.name, self.slots, self.free, self.filled, self.gain))
+        self.process.daemon = True
+        self.process.start()
+        metrics.incr('dsp.started')
+
+    def set_gain(self, gain):
+        # frames already in the ring are rescaled as they are read
+        self.gain.value = gain
+
+    def read(self):
+        """Next frame of PCM, None at the end of the track."""
+        while not self.filled.acquire(timeout=0.5):
+            if self.process is None:
+                return None
+            if self.process.is_alive():
+                continue
+            # it may have written a frame just before dying
+            if self.filled.acquire(block=False):
+                break
+            if not self.restart():
+                return None
+        length = self.lengths[self.slot]
+        if length == 0:
+            return None
+        start = self.slot * FRAME_BYTES
+        data = bytes(self.frames[start:start + length * 2])
+        gain = self.gains[self.slot]
+        self.free.release()
+        self.slot = (self.slot + 1) % self.slots
+        self.position += length / 48000
+        if abs(gain - self.gain.value) > 0.0001:
+            data = audioop.mul(data, 2, self.gain.value / gain) if gain > 0 else bytes(len(data))
+        return data
+
+    def restart(self):
+        exitcode = self.process.exitcode
+        if exitcode == 0 or self.restarts >= self.max_restarts:
+            logging.error('Decoder process ended with code {} at {:.1f}s'.format(exitcode, self.position))
+            self.process = None
+            return False
+        self.restarts += 1
+        metrics.incr('dsp.restarts')
+        logging.warning('Decoder process died with code {}, restarting it at {:.1f}s'.format(exitcode, self.position))
+        self.start()
+        return True
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.kill()
+            self.process = None
+        self.lengths.release()
+        self.gains.release()
+        self.frames.release()
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,119 @@
+import logging
+import os
+import queue
+import threading
+import variables as var
+import metrics
+
+# Background extraction of the tags and duration of library files (any format
+# mutagen knows), stored in the library index so that queue entries carry them
+# without opening the file at play time.
+
+tag_fields = ['title', 'artist', 'album']
+
+_lock = threading.Lock()
+_queue = queue.Queue()
+_pending = set()
+_waiting = {}  # file -> queue entries to update once it is read
+_worker_thread = None
+
+
+def read_tags(path):
+    """Tags and duration of an audio file, None if mutagen can't read it."""
+    import mutagen
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        logging.debug('Could not read tags of {}: {}'.format(path, e))
+        return None
+    if audio is None:
+        return None
+    tags = {'duration': audio.info.length if audio.info else 0}
+    for field in tag_fields:
+        try:
+            values = audio.tags.get(field) if audio.tags else None
+        except Exception:
+            values = None
+        if values:
+            tags[field] = str(values[0])
+    return tags
+
+
+def entry_tags(meta):
+    """Fields of a queue entry from the metadata of the library index."""
+    tags = {k: meta[k] for k in tag_fields if k in meta}
+    # in minutes, like the URL entries
+    tags['duration'] = meta['duration'] / 60
+    return tags
+
+
+def get_music(path, user):
+    """Queue entry for a library file."""
+    music = {'type': 'file',
+             'path': path,
+             'user': user,
+             'start': 0,
+             'end': 0}
+    meta = var.library.get_file_meta(path)
+    if 'duration' in meta:
+        music.update(entry_tags(meta))
+    else:
+        # not read yet, named after the file until the worker fills in its tags
+        music['title'] = os.path.basename(path)
+        submit_library([path], [music])
+    return music
+
+
+def get_title(music):
+    if 'title' in music and 'artist' in music:
+        return '{} - {}'.format(music['artist'], music['title'])
+    return music.get('title') or music['path']
+
+
+def submit_library(files, entries=None):
+    """Read the tags of the files in the background. The queue entries given
+    (one per file) are updated once their file is read."""
+    global _worker_thread
+    with _lock:
+        for i, file in enumerate(files):
+            meta = var.library.get_file_meta(file)
+            if 'duration' in meta:
+                # read meanwhile
+                if entries:
+                    entries[i].update(entry_tags(meta))
+                continue
+            if entries:
+                _waiting.setdefault(file, []).append(entries[i])
+            if file not in _pending:
+                _pending.add(file)
+                _queue.put(file)
+        if _worker_thread is None and not _queue.empty():
+            _worker_thread = threading.Thread(target=_worker, name='tags')
+            _worker_thread.daemon = True
+            _worker_thread.start()
+    metrics.gauge('tags.pending', _queue.qsize())
+
+
+def _worker():
+    done = 0
+    while True:
+        file = _queue.get()
+        tags = read_tags(os.path.join(var.music_folder, file))
+        if tags is None:
+            # not something mutagen reads (e.g. MIDI), don't retry on every scan
+            tags = {'duration': 0}
+            metrics.incr('tags.failed')
+        else:
+            metrics.incr('tags.read')
+        var.library.set_file_meta(file, **tags)
+        with _lock:
+            _pending.discard(file)
+            entries = _waiting.pop(file, [])
+        for music in entries:
+            music.update(entry_tags(tags))
+        done += 1
+        metrics.gauge('tags.pending', _queue.qsize())
+
+        if done % 200 == 0 or _queue.empty():
+            var.library.save()
+            done = 0
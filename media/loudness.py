@@ -0,0 +1,98 @@
+import logging
+import os
+import queue
+import re
+import subprocess as sp
+import threading
+import variables as var
+import metrics
+
+# Background EBU R128 analysis of library files and URL tracks. Results are
+# stored in the library index as 'loudness' (LUFS) and 'peak' (dBFS) and turned
+# into a per-track gain by get_gain().
+
+_lock = threading.Lock()
+_queue = queue.Queue()
+_pending = set()
+_workers = []
+
+
+def analyze(uri):
+    command = ['ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', uri,
+               '-vn', '-af', 'ebur128=peak=true', '-f', 'null', '-']
+    if uri.startswith('http'):
+        command[1:1] = ['-reconnect', '1', '-reconnect_streamed', '1']
+    logging.debug("Loudness command : " + " ".join(command))
+    process = sp.run(command, stdout=sp.DEVNULL, stderr=sp.PIPE, preexec_fn=lambda: os.nice(19))
+    output = process.stderr.decode('utf-8', errors='ignore')
+    # the summary is printed last, after the per-frame logs
+    loudness = re.findall(r'I:\s+(-?[\d.]+|-inf) LUFS', output)
+    peak = re.findall(r'Peak:\s+(-?[\d.]+|-inf) dBFS', output)
+    if process.returncode != 0 or not loudness:
+        return None
+    return float(loudness[-1]), float(peak[-1]) if peak else 0.0
+
+
+def get_gain(meta):
+    """Linear gain to apply to a track, 1.0 if it was not analyzed yet."""
+    if not var.config.getboolean('bot', 'loudness_normalization') or 'loudness' not in meta:
+        return 1.0
+    if meta['loudness'] == float('-inf'):
+        return 1.0
+    gain_db = var.config.getfloat('bot', 'loudness_target') - meta['loudness']
+    # never push the peak above -1 dBFS, and keep the boost reasonable
+    gain_db = min(gain_db, -1.0 - meta.get('peak', 0.0), var.config.getfloat('bot', 'loudness_max_gain'))
+    return 10 ** (gain_db / 20)
+
+
+def submit(key, uri, is_file=True):
+    if not var.config.getboolean('bot', 'loudness_normalization'):
+        return
+    with _lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+        if not _workers:
+            for i in range(var.config.getint('bot', 'loudness_workers')):
+                t = threading.Thread(target=_worker, name='loudness-{}'.format(i))
+                t.daemon = True
+                t.start()
+                _workers.append(t)
+    _queue.put((key, uri, is_file))
+    metrics.gauge('loudness.pending', _queue.qsize())
+
+
+def submit_library(files):
+    for file in files:
+        if 'loudness' not in var.library.get_file_meta(file):
+            submit(file, os.path.join(var.music_folder, file))
+
+
+def _worker():
+    done = 0
+    while True:
+        key, uri, is_file = _queue.get()
+        try:
+            result = analyze(uri)
+        except Exception as e:
+            logging.error('Loudness analysis of {} failed: {}'.format(uri, e))
+            result = None
+        with _lock:
+            _pending.discard(key)
+
+        if result:
+            loudness, peak = result
+            logging.debug('Loudness of {}: {} LUFS, peak {} dBFS'.format(key, loudness, peak))
+            if is_file:
+                var.library.set_file_meta(key, loudness=loudness, peak=peak)
+            else:
+                var.library.set_meta(key, loudness=loudness, peak=peak)
+            metrics.incr('loudness.analyzed')
+            done += 1
+        else:
+            metrics.incr('loudness.failed')
+        metrics.gauge('loudness.pending', _queue.qsize())
+
+        if done and (done % 20 == 0 or _queue.empty()):
+            var.library.save()
+            done = 0
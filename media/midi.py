@@ -0,0 +1,161 @@
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import subprocess as sp
+import threading
+import variables as var
+import metrics
+
+# MIDI files are rendered with the current soundfont to FLAC in a background
+# process, so that later plays stream the cache through ffmpeg instead of
+# running FluidSynth in real time. The cache file name is made of the MIDI
+# content hash and of the soundfont identity (path, size and mtime), so
+# changing either of them makes a new entry; the least recently played
+# renders are removed past midi_cache_max_size.
+
+synth_args = {
+    'player.timing-source': 'sample',
+    'synth.lock-memory': 0,
+    'synth.chorus.level': 0.0,
+    'synth.reverb.level': 0.0,
+}
+
+_lock = threading.Lock()
+_rendering = set()
+_render_slot = threading.Semaphore(1)
+
+
+def load(uri):
+    if uri.lower().startswith('https://') or uri.lower().startswith('http://'):
+        import requests
+        r = requests.get(uri, timeout=10)
+        if r.status_code == requests.codes.ok:
+            return r.content
+        return None
+    with open(uri, 'rb') as f:
+        return f.read()
+
+
+def is_enabled():
+    return var.config.getboolean('bot', 'midi_cache')
+
+
+def get_cache_path(content, soundfont):
+    stat = os.stat(soundfont)
+    sf_id = '{}:{}:{}'.format(os.path.abspath(soundfont), stat.st_size, stat.st_mtime)
+    midi_hash = hashlib.sha1(content).hexdigest()
+    sf_hash = hashlib.sha1(sf_id.encode()).hexdigest()[:16]
+    return os.path.join(var.config.get('bot', 'midi_cache_folder'), '{}_{}.flac'.format(midi_hash, sf_hash))
+
+
+def get_cached(content, soundfont):
+    """Path of the rendered MIDI if it is in the cache, None otherwise."""
+    if not is_enabled():
+        return None
+    try:
+        path = get_cache_path(content, soundfont)
+    except OSError:
+        return None
+    if os.path.isfile(path):
+        metrics.incr('midi_cache.hits')
+        try:
+            # the mtime orders the eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+    metrics.incr('midi_cache.misses')
+    return None
+
+
+def submit_render(content, soundfont):
+    if not is_enabled():
+        return
+    try:
+        path = get_cache_path(content, soundfont)
+    except OSError:
+        return
+    with _lock:
+        if path in _rendering:
+            return
+        _rendering.add(path)
+    t = threading.Thread(target=_render_in_background, args=(content, soundfont, path))
+    t.daemon = True
+    t.start()
+
+
+def _render_in_background(content, soundfont, path):
+    try:
+        with _render_slot:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # spawn instead of fork, the bot process is multithreaded
+            process = multiprocessing.get_context('spawn').Process(target=render, args=(content, soundfont, path))
+            process.start()
+            process.join()
+            if process.exitcode == 0:
+                logging.info('MIDI rendered to ' + path)
+                metrics.incr('midi_cache.rendered')
+                evict(os.path.dirname(path))
+            else:
+                logging.error('MIDI rendering to {} failed'.format(path))
+                metrics.incr('midi_cache.failed')
+    except OSError as e:
+        logging.error('MIDI rendering to {} failed: {}'.format(path, e))
+    finally:
+        with _lock:
+            _rendering.discard(path)
+
+
+def evict(folder):
+    """Remove the least recently played renders past midi_cache_max_size."""
+    max_size = var.config.getint('bot', 'midi_cache_max_size')
+    if max_size < 0:
+        return
+    files = []
+    for file in glob.glob(os.path.join(folder, '*.flac')):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, file))
+    total = 0
+    for mtime, size, file in sorted(files, reverse=True):
+        total += size
+        if total > max_size * 1024 * 1024:
+            try:
+                os.remove(file)
+                metrics.incr('midi_cache.evicted')
+            except OSError:
+                pass
+
+
+def render(content, soundfont, path):
+    # Runs in a separate process: synthesize as fast as possible and encode to FLAC
+    import pyfluidsynth.fluidsynth as fluidsynth
+    os.nice(10)
+    tmpfile = path + '.tmp'
+    encoder = sp.Popen(['ffmpeg', '-v', 'warning', '-f', 's16le', '-ar', '48000', '-ac', '1', '-i', '-',
+                        '-c:a', 'flac', '-f', 'flac', '-y', tmpfile], stdin=sp.PIPE)
+    synth = fluidsynth.Synth(gain=0.25, samplerate=48000, **synth_args)
+    synth.start()
+    synth.sfload(soundfont)
+    player = fluidsynth.Player(synth)
+    player.add(content)
+    player.play()
+    try:
+        while player.status() == fluidsynth.Player.PLAYING:
+            a = synth.get_samples(4800)
+            if a.size == 0:
+                break
+            encoder.stdin.write((a[::2] + a[1::2]).tobytes())
+    finally:
+        player.stop()
+        player.delete()
+        synth.delete()
+        encoder.stdin.close()
+    if encoder.wait() != 0:
+        os.remove(tmpfile)
+        raise SystemExit(1)
+    os.replace(tmpfile, path)
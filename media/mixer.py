@@ -0,0 +1,119 @@
+import audioop
+
+# Mixes short sources (sound effects, announcements) over the music, ducking
+# the music while they play. The music stays the clock: the mixer outputs a
+# frame each time enough music was pushed, or a frame of effects alone when no
+# music plays. When no effect plays, the music goes through untouched.
+
+FRAME_SIZE = 960  # samples, 20 ms at 48 kHz
+
+
+class Effect:
+    def __init__(self, source, gain, duck):
+        self.source = source
+        self.gain = gain
+        self.duck = duck
+        self.pending = bytearray()
+        self.finished = False
+
+    def read(self, size):
+        """`size` bytes of PCM, padded with silence when the source ends."""
+        while len(self.pending) < size and not self.finished:
+            chunk = self.source.next()
+            if chunk:
+                self.pending += chunk
+            else:
+                self.finished = True
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data.ljust(size, b'\x00')
+
+    def done(self):
+        return self.finished and not self.pending
+
+
+class Mixer:
+    def __init__(self, duck_level=0.3, attack=0.05, release=0.5):
+        import numpy
+        self.numpy = numpy
+        self.duck_level = duck_level
+        self.attack = attack
+        self.release = release
+        self.effects = []
+        self.duck_gain = 1.0
+        self.pending = bytearray()  # music waiting for a full frame
+        # preallocated buffers, reused for every frame
+        self.line = numpy.linspace(0, 1, FRAME_SIZE, endpoint=False, dtype=numpy.float32)
+        self.ramp = numpy.empty(FRAME_SIZE, dtype=numpy.float32)
+        self.mix_buffer = numpy.empty(FRAME_SIZE, dtype=numpy.float32)
+        self.effect_buffer = numpy.empty(FRAME_SIZE, dtype=numpy.float32)
+        self.output = numpy.empty(FRAME_SIZE, dtype=numpy.int16)
+
+    def add(self, source, gain=1.0, duck=True):
+        self.effects.append(Effect(source, gain, duck))
+
+    def clear(self):
+        for effect in self.effects:
+            effect.source.stop()
+        self.effects = []
+
+    def active(self):
+        return bool(self.effects) or bool(self.pending) or self.duck_gain < 1.0
+
+    def mix(self, music, music_gain):
+        """Mix the music PCM (None if no music plays) with the effects, returns the PCM to send."""
+        if music is None:
+            if not self.effects:
+                # the music stopped while ducked, send what is left of it
+                self.duck_gain = 1.0
+                data = bytes(self.pending)
+                self.pending.clear()
+                return audioop.mul(data, 2, music_gain)
+            # effects alone, one frame at a time
+            return self.mix_frame(None, 0.0)
+
+        if not self.effects and self.duck_gain >= 1.0:
+            data = bytes(self.pending) + music
+            self.pending.clear()
+            return audioop.mul(data, 2, music_gain)
+
+        self.pending += music
+        out = b''
+        while len(self.pending) >= FRAME_SIZE * 2:
+            frame = bytes(self.pending[:FRAME_SIZE * 2])
+            del self.pending[:FRAME_SIZE * 2]
+            out += self.mix_frame(frame, music_gain)
+        return out
+
+    def mix_frame(self, music, music_gain):
+        numpy = self.numpy
+        ducking = any(effect.duck for effect in self.effects)
+        target = self.duck_level if ducking else 1.0
+        step = FRAME_SIZE / 48000 / (self.attack if target < self.duck_gain else self.release)
+        start = self.duck_gain
+        if target < start:
+            self.duck_gain = max(target, start - step * (1 - self.duck_level))
+        else:
+            self.duck_gain = min(target, start + step * (1 - self.duck_level))
+
+        mix = self.mix_buffer
+        if music is None:
+            mix.fill(0)
+        else:
+            # music gain ramps from the previous to the new ducking level over the frame
+            numpy.multiply(self.line, (self.duck_gain - start) * music_gain, out=self.ramp)
+            self.ramp += start * music_gain
+            numpy.multiply(numpy.frombuffer(music, dtype=numpy.int16), self.ramp, out=mix)
+
+        for effect in self.effects:
+            numpy.multiply(numpy.frombuffer(effect.read(FRAME_SIZE * 2), dtype=numpy.int16), effect.gain,
+                           out=self.effect_buffer)
+            mix += self.effect_buffer
+        for effect in self.effects:
+            if effect.done():
+                effect.source.stop()
+        self.effects = [effect for effect in self.effects if not effect.done()]
+
+        numpy.clip(mix, -32768, 32767, out=mix)
+        self.output[:] = mix
+        return self.output.tobytes()
@@ -0,0 +1,149 @@
+import collections
+import socket
+import struct
+import threading
+import time
+from pymumble.pymumble_py3.constants import PYMUMBLE_AUDIO_TYPE_OPUS, PYMUMBLE_MSG_TYPES_UDPTUNNEL, \
+    PYMUMBLE_SEQUENCE_DURATION, PYMUMBLE_SEQUENCE_RESET_INTERVAL
+from pymumble.pymumble_py3.tools import VarInt
+
+# Opus passthrough: Opus packets demuxed from the source by ffmpeg are sent as
+# they are, skipping the decode / downmix / re-encode passes of the PCM path.
+
+
+def packet_duration(packet):
+    """Duration in seconds of an Opus packet, from its TOC byte (RFC 6716, 3.1)."""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (0.010, 0.020, 0.040, 0.060)[config & 3]
+    elif config < 16:
+        frame = (0.010, 0.020)[config & 1]
+    else:
+        frame = (0.0025, 0.005, 0.010, 0.020)[config & 3]
+    code = toc & 3
+    if code == 0:
+        count = 1
+    elif code < 3:
+        count = 2
+    else:
+        count = packet[1] & 0x3f if len(packet) > 1 else 0
+    return frame * count
+
+
+class OggOpusReader:
+    """Reads Opus packets from an Ogg stream (RFC 7845), skipping the header packets."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.packets = collections.deque()
+        self.partial = b''
+        self.headers = 2  # OpusHead and OpusTags
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _read_page(self):
+        header = self._read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            return False
+        lacing = self._read(header[26])
+        for size in lacing:
+            self.partial += self._read(size)
+            if size < 255:
+                if self.headers > 0:
+                    self.headers -= 1
+                elif self.partial:
+                    self.packets.append(self.partial)
+                self.partial = b''
+        return True
+
+    def read_packet(self):
+        while not self.packets:
+            if not self._read_page():
+                return None
+        return self.packets.popleft()
+
+
+class OpusOutput:
+    """Queue of encoded Opus packets sent alongside pymumble's PCM output.
+
+    The packets are sent from the pymumble thread (by hooking
+    SoundOutput.send_audio) so that the socket is only written by one thread,
+    and share the sequence numbering of the PCM output.
+    """
+
+    def __init__(self, mumble):
+        self.mumble = mumble
+        self.sound_output = None
+        self.lock = threading.Lock()
+        self.packets = collections.deque()
+        self.on_packet = None  # called with the size of each packet sent
+        self.hook()
+
+    def hook(self):
+        # pymumble creates a new SoundOutput on reconnection
+        sound_output = self.mumble.sound_output
+        if sound_output is self.sound_output:
+            return
+        original_send_audio = sound_output.send_audio
+
+        def send_audio():
+            self.send_packets(sound_output)
+            return original_send_audio()
+        sound_output.send_audio = send_audio
+        self.sound_output = sound_output
+
+    def add_packet(self, packet, duration):
+        self.hook()
+        with self.lock:
+            self.packets.append((packet, duration))
+
+    def get_buffer_size(self):
+        with self.lock:
+            return sum(duration for packet, duration in self.packets)
+
+    def clear_buffer(self):
+        with self.lock:
+            self.packets.clear()
+
+    def send_packets(self, so):
+        # same timing and sequence logic as SoundOutput.send_audio
+        while True:
+            # clear_buffer may empty the queue from the audio loop meanwhile
+            with self.lock:
+                if not self.packets:
+                    return
+                packet, duration = self.packets[0]
+                current_time = time.time()
+                if so.sequence_last_time + duration > current_time:
+                    return
+                self.packets.popleft()
+
+            if so.sequence_last_time + PYMUMBLE_SEQUENCE_RESET_INTERVAL <= current_time:
+                so.sequence = 0
+                so.sequence_start_time = current_time
+                so.sequence_last_time = current_time
+            elif so.sequence_last_time + (duration * 2) <= current_time:
+                so.sequence = int((current_time - so.sequence_start_time) / PYMUMBLE_SEQUENCE_DURATION)
+                so.sequence_last_time = so.sequence_start_time + (so.sequence * PYMUMBLE_SEQUENCE_DURATION)
+            else:
+                so.sequence += max(1, int(round(duration / PYMUMBLE_SEQUENCE_DURATION)))
+                so.sequence_last_time = so.sequence_start_time + (so.sequence * PYMUMBLE_SEQUENCE_DURATION)
+
+            payload = VarInt(len(packet)).encode() + packet
+            udppacket = struct.pack('!B', PYMUMBLE_AUDIO_TYPE_OPUS << 5 | so.target) + VarInt(so.sequence).encode() + payload
+            tcppacket = struct.pack("!HL", PYMUMBLE_MSG_TYPES_UDPTUNNEL, len(udppacket)) + udppacket
+            while len(tcppacket) > 0:
+                sent = self.mumble.control_socket.send(tcppacket)
+                if sent < 0:
+                    raise socket.error("Server socket error")
+                tcppacket = tcppacket[sent:]
+            if self.on_packet:
+                self.on_packet(len(packet))
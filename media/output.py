@@ -0,0 +1,55 @@
+import audioop
+
+# Changes applied to the PCM already queued in pymumble's SoundOutput, so that
+# skip, stop and volume changes are heard within a frame or two instead of
+# after the buffered audio. SoundOutput.pcm is a list of encoder frames that
+# the pymumble thread pops under SoundOutput.lock; it is modified in place.
+
+
+def _ramp(frame, start, end):
+    import numpy
+    a = numpy.frombuffer(frame, dtype=numpy.int16).astype(numpy.float32)
+    a *= numpy.linspace(start, end, len(a), dtype=numpy.float32)
+    return numpy.clip(a, -32768, 32767).astype(numpy.int16).tobytes()
+
+
+def _split(sound_output, duration):
+    # number of pending frames covering `duration` seconds
+    size = int(duration * 48000 * 2 * sound_output.channels)
+    count = 0
+    for frame in sound_output.pcm:
+        if size <= 0:
+            break
+        size -= len(frame)
+        count += 1
+    return count
+
+
+def fade_out(sound_output, duration=0.02):
+    """Truncate the pending audio to `duration` seconds, faded to silence."""
+    with sound_output.lock:
+        frames = sound_output.pcm[:_split(sound_output, duration)]
+        total = sum(len(frame) for frame in frames)
+        position = 0
+        for i, frame in enumerate(frames):
+            frames[i] = _ramp(frame, 1 - position / total, 1 - (position + len(frame)) / total)
+            position += len(frame)
+        sound_output.pcm[:] = frames
+
+
+def set_gain(sound_output, ratio, duration=0.02):
+    """Scale the pending audio by `ratio`, ramping over the first `duration` seconds."""
+    if ratio == 1.0:
+        return
+    with sound_output.lock:
+        frames = sound_output.pcm
+        count = _split(sound_output, duration)
+        total = sum(len(frame) for frame in frames[:count])
+        position = 0
+        for i, frame in enumerate(frames):
+            if i < count:
+                start = 1 + (ratio - 1) * position / total
+                position += len(frame)
+                frames[i] = _ramp(frame, start, 1 + (ratio - 1) * position / total)
+            else:
+                frames[i] = audioop.mul(frame, 2, ratio)
@@ -2,10 +2,87 @@ import json
 import subprocess
 import variables as var
 import media.url
+import media.resolver
 
 
 def get_playlist_info(url, start_index=1, user=""):
-    musics = media.url.get_url_info(url, user)
-    if musics:
-        return musics[(start_index-1):var.config.getint('bot', 'max_track_playlist')]
-    return None
+    """Entries of a playlist, listed without resolving them (flat extraction).
+
+    They are queued as placeholders marked 'unresolved', and resolved by
+    resolve() shortly before they play.
+    """
+    try:
+        args = [var.config.get('bot', 'ytdl_path'), '-J', '--flat-playlist', url]
+        info = media.resolver.ytdl_json(args)
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        print(e)
+        return None
+    if info.get('_type') != 'playlist':
+        return media.url.get_url_info(url, user)
+
+    start = start_index - 1
+    musics = []
+    for entry in info.get('entries', [])[start:start + var.config.getint('bot', 'max_track_playlist')]:
+        entry_url = entry.get('url') or entry.get('id')
+        if not entry_url:
+            continue
+        if not entry_url.startswith('http') and entry.get('ie_key') == 'Youtube':
+            entry_url = 'https://www.youtube.com/watch?v=' + entry_url
+        musics.append({'type': 'url',
+                       'url': entry_url,
+                       'user': user,
+                       'start': 0,
+                       'end': -1,
+                       'duration': (entry.get('duration') or 0) / 60,
+                       'title': entry.get('title') or entry_url,
+                       'from_playlist': True,
+                       'playlist_title': info.get('title'),
+                       'playlist_url': url,
+                       'unresolved': True})
+    return musics
+
+
+def resolve(music):
+    """Resolve a playlist placeholder in place, returns False if it can't be played."""
+    musics = media.url.get_url_info(music['url'], music['user'])
+    if not musics:
+        # not resolved ahead again, only tried once more when its turn comes
+        music['resolve_failed'] = True
+        return False
+    resolved = {k: v for k, v in musics[0].items() if k not in ('user', 'from_playlist', 'playlist_title', 'playlist_url')}
+    music.update(resolved)
+    music.pop('unresolved', None)
+    music.pop('resolve_failed', None)
+    return True
+
+
+class Playlist(list):
+    """The queue of a bot. The first item is the one currently playing.
+
+    Every change calls `on_change`, which the bot uses to version its state
+    for the web interface.
+    """
+
+    def __init__(self, on_change=None):
+        super().__init__()
+        self.on_change = on_change
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+
+def _notifying(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.changed()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ['append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse',
+              '__setitem__', '__delitem__', '__iadd__']:
+    setattr(Playlist, _name, _notifying(_name))
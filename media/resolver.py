@@ -0,0 +1,53 @@
+import json
+import logging
+import subprocess
+import threading
+import time
+import variables as var
+
+# Pool of youtube-dl slots and metadata cache, shared by every bot of the process
+_lock = threading.Lock()
+_slots = None
+_cache = {}
+
+
+def get_slots():
+    global _slots
+    with _lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(var.config.getint('bot', 'resolver_workers', fallback=2))
+        return _slots
+
+
+def ytdl_json(args):
+    key = tuple(args)
+    ttl = var.config.getint('bot', 'metadata_cache_ttl', fallback=3600)
+    now = time.time()
+    with _lock:
+        if key in _cache:
+            timestamp, info = _cache[key]
+            if now - timestamp < ttl:
+                logging.debug('youtube-dl cache hit: ' + str(args))
+                return info
+            del _cache[key]
+
+    logging.debug('youtube-dl command: ' + str(args))
+    with get_slots():
+        info = json.loads(subprocess.check_output(args))
+
+    with _lock:
+        now = time.time()
+        for k in [k for k, v in _cache.items() if now - v[0] >= ttl]:
+            del _cache[k]
+        _cache[key] = (now, info)
+    return info
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def warm_up():
+    # youtube-dl takes seconds to start from a cold disk cache
+    subprocess.run([var.config.get('bot', 'ytdl_path'), '--version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -0,0 +1,116 @@
+import collections
+import logging
+import os
+import threading
+import util
+import metrics
+import media.midi
+
+
+class SoundfontManager:
+    """Soundfonts shared by every bot of the process.
+
+    FluidSynth keeps the sample data of a soundfont in a process-wide cache as
+    long as one synth references it, so loading a retained soundfont in
+    another synth only parses its presets. Recently used soundfonts are kept
+    retained by holder synths, evicted in LRU order when their total size
+    exceeds `max_size` bytes.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.holders = collections.OrderedDict()  # path -> (synth, size)
+        self.loading = {}  # path -> threading.Event
+        self.catalog = None
+        self.catalog_signature = None
+
+    @staticmethod
+    def new_synth():
+        import pyfluidsynth.fluidsynth as fluidsynth
+        synth = fluidsynth.Synth(gain=0.25, samplerate=48000, **media.midi.synth_args)
+        synth.start()
+        return synth
+
+    def retain(self, path):
+        """Load the soundfont in a holder synth if needed. Blocks until it is loaded.
+
+        Returns False if the soundfont can't be loaded.
+        """
+        with self.lock:
+            if path in self.holders:
+                self.holders.move_to_end(path)
+                metrics.incr('soundfont.hits')
+                return True
+            event = self.loading.get(path)
+            owner = event is None
+            if owner:
+                event = self.loading[path] = threading.Event()
+        if not owner:
+            event.wait()
+            with self.lock:
+                return path in self.holders
+
+        try:
+            logging.info('Loading soundfont ' + path)
+            synth = self.new_synth()
+            if synth.sfload(path) < 0:
+                # corrupt or unreadable, not worth keeping
+                logging.error('Could not load soundfont ' + path)
+                synth.delete()
+                metrics.incr('soundfont.failed')
+                return False
+            with self.lock:
+                self.holders[path] = (synth, os.path.getsize(path))
+                self._evict()
+            metrics.incr('soundfont.loaded')
+            return True
+        finally:
+            with self.lock:
+                del self.loading[path]
+            event.set()
+
+    def _evict(self):
+        total = sum(size for synth, size in self.holders.values())
+        while total > self.max_size and len(self.holders) > 1:
+            path, (synth, size) = self.holders.popitem(last=False)
+            logging.info('Evicting soundfont ' + path)
+            synth.delete()
+            total -= size
+            metrics.incr('soundfont.evicted')
+        metrics.gauge('soundfont.retained_bytes', total)
+
+    def load(self, synth, path, update_midi_preset=False):
+        """Load the soundfont into `synth`, returns its id (-1 if it can't be loaded)."""
+        if not self.retain(path):
+            return -1
+        return synth.sfload(path, update_midi_preset)
+
+    def preload(self, path, callback=None):
+        def run():
+            try:
+                if not self.retain(path):
+                    return
+            except Exception as e:
+                logging.error('Could not load soundfont {}: {}'.format(path, e))
+                return
+            if callback:
+                callback()
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def get_catalog(self):
+        # the (expensive) scan is only redone when a directory changed
+        signature = []
+        for root, dirs, files in os.walk(self.folder, followlinks=True):
+            signature.append((root, os.path.getmtime(root)))
+        with self.lock:
+            if signature == self.catalog_signature:
+                return self.catalog
+        catalog = util.get_recursive_filelist_sorted(self.folder, False)
+        with self.lock:
+            self.catalog = catalog
+            self.catalog_signature = signature
+        return catalog
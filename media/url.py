@@ -4,6 +4,7 @@ import re
 import subprocess
 import variables as var
 import urllib
+import media.resolver
 
 def find_best_audio(info):
     fid = info.get('format_id')
@@ -23,6 +24,9 @@ def build_dict(info, user="", start=0, end=-1):
     music = {
         'type': 'url',
         'format_id': f.get('format_id') if f else None,
+        'acodec': f.get('acodec') if f else None,
+        'asr': f.get('asr') if f else None,
+        'abr': f.get('abr') if f else None,
         'path': f.get('url') if f else None,
         'url': info['webpage_url'],
         'user': user,
@@ -54,17 +58,25 @@ def get_component_time(components, key):
 
 ytdl_opts = ['-J', '-x', '-f', 'bestaudio/best']
 
-def search(keyword, user=""):
+def search(keyword, count=1):
+    """Top results of a YouTube search, without resolving them (flat extraction).
+
+    Returns a list of {'title', 'url', 'duration'}, or None on error.
+    """
     for i in range(2):
         try:
-            args = [var.config.get('bot', 'ytdl_path')] + ytdl_opts + ['ytsearch:' + keyword]
-            logging.debug('youtube-dl command: ' + str(args))
-            info = json.loads(subprocess.check_output(args))
-
-            if 'entries' in info:
-                return [build_dict(info['entries'][0], user)]
+            args = [var.config.get('bot', 'ytdl_path'), '-J', '--flat-playlist', 'ytsearch{}:{}'.format(count, keyword)]
+            info = media.resolver.ytdl_json(args)
 
-            return []
+            results = []
+            for entry in info.get('entries', []):
+                url = entry.get('url') or entry['id']
+                if not url.startswith('http'):
+                    url = 'https://www.youtube.com/watch?v=' + entry['id']
+                results.append({'title': entry.get('title') or url,
+                                'url': url,
+                                'duration': (entry.get('duration') or 0) / 60})
+            return results
         except subprocess.CalledProcessError as e:
             print(e)
         except json.JSONDecodeError as e:
@@ -80,8 +92,7 @@ def get_url_info(url, user=""):
     for i in range(2):
         try:
             args =  [var.config.get('bot', 'ytdl_path'), '--no-playlist'] + ytdl_opts + [url]
-            logging.debug('youtube-dl command: ' + str(args))
-            info = json.loads(subprocess.check_output(args))
+            info = media.resolver.ytdl_json(args)
 
             if info.get('_type') == 'playlist':
                 entries = [build_dict(t, user) for t in info['entries']]
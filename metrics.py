@@ -0,0 +1,35 @@
+import threading
+
+_lock = threading.Lock()
+_values = {}
+
+
+def gauge(name, value):
+    with _lock:
+        _values[name] = value
+
+
+def incr(name, amount=1):
+    with _lock:
+        _values[name] = _values.get(name, 0) + amount
+
+
+def get(name, default=None):
+    with _lock:
+        return _values.get(name, default)
+
+
+def get_all(prefix=''):
+    with _lock:
+        return {k: v for k, v in _values.items() if k.startswith(prefix)}
+
+
+def render(prefix=''):
+    values = get_all(prefix)
+    lines = []
+    for name in sorted(values):
+        value = values[name]
+        if isinstance(value, float):
+            value = '{:.3f}'.format(value)
+        lines.append('{}: {}'.format(name, value))
+    return lines
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-import threading
 import time
+startup_time = time.time()
+import threading
+import concurrent.futures
 import sys
 import signal
 import configparser
@@ -11,26 +13,36 @@ import argparse
 import os
 import os.path
 import pymumble.pymumble_py3 as pymumble
-import interface
+import control
+import multiprocessing
 import variables as var
+import settings
 import hashlib
 import logging
 import util
 import html
 import base64
-import requests
-import numpy
 import glob
-import pyfluidsynth.fluidsynth as fluidsynth
-from PIL import Image
-from io import BytesIO
-from mutagen.easyid3 import EasyID3
 import re
 import media.url
+import media.resolver
 import media.file
 import media.playlist
 import media.radio
 import media.system
+import media.loudness
+import media.midi
+import media.soundfont
+import media.opus
+import media.output
+import media.mixer
+import media.dsp
+import metrics
+import outbox
+import bandwidth
+import quota
+import jitter
+import library
 
 
 class Future(threading.Event):
@@ -45,173 +57,217 @@ class Future(threading.Event):
         return self.retval
 
 class MusicSourceSubprocess:
-    def __init__(self, process):
+    passthrough = False
+    scaled = False
+    def __init__(self, process, start=0):
+        import numpy
+        self.numpy = numpy
         self.process = process
+        self.position = start
     def active(self):
         return self.process is not None
     def next(self):
         a = self.process.stdout.read(480)
         if a:
-            a = numpy.frombuffer(a, dtype=numpy.int16)
+            a = self.numpy.frombuffer(a, dtype=self.numpy.int16)
+            self.position += len(a) / 2 / 48000
             return (a[::2] // 2 + a[1::2] // 2).tobytes()
         return None
-    def set_soundfont(self):
-        pass
     def stop(self):
         self.process.kill()
         self.process = None
 
-class MusicSourceFluidSynth:
-    def __init__(self, soundfont, uri):
-        content = None
-        if uri.lower().startswith('https://') or uri.lower().startswith('http://'):
-            r = requests.get(uri, timeout=10)
-            if r.status_code == requests.codes.ok:
-                content = r.content
-        else:
-            with open(uri, 'rb') as f:
-                content = f.read()
+class MusicSourceOpus:
+    # Yields (Opus packet, duration) instead of PCM, see media.opus
+    passthrough = True
+    scaled = False
+    def __init__(self, process, start=0):
+        self.process = process
+        self.reader = media.opus.OggOpusReader(process.stdout)
+        self.position = start
+    def active(self):
+        return self.process is not None
+    def next(self):
+        packet = self.reader.read_packet()
+        if packet:
+            duration = media.opus.packet_duration(packet)
+            self.position += duration
+            return packet, duration
+        return None
+    def stop(self):
+        self.process.kill()
+        self.process = None
+
+class MusicSourceWorker:
+    # Decoded, downmixed and scaled by a worker process, see media.dsp
+    passthrough = False
+    scaled = True
+    def __init__(self, decoder, start=0):
+        self.decoder = decoder
+        self.start = start
+    @property
+    def position(self):
+        return self.start + self.decoder.position
+    def active(self):
+        return self.decoder is not None
+    def next(self):
+        return self.decoder.read()
+    def set_gain(self, gain):
+        self.decoder.set_gain(gain)
+    def stop(self):
+        self.decoder.stop()
+        self.decoder = None
 
+class MusicSourceFluidSynth:
+    # The synth belongs to the bot and is reused by every MIDI track, only the player is per track
+    passthrough = False
+    scaled = False
+    def __init__(self, synth, content):
+        import pyfluidsynth.fluidsynth as fluidsynth
+        self.playing = fluidsynth.Player.PLAYING
+        self.synth = synth
+        self.player = None
         if content:
-            args = {
-                    'player.timing-source': 'sample',
-                    'synth.lock-memory': 0,
-                    'synth.chorus.level': 0.0,
-                    'synth.reverb.level': 0.0,
-                    }
-            self.synth = fluidsynth.Synth(gain=0.25, samplerate=48000, **args)
-            self.synth.start()
-            self.sfid = self.synth.sfload(soundfont)
             self.player = fluidsynth.Player(self.synth)
             self.player.add(content)
             self.player.play()
-        else:
-            self.synth = None
     def active(self):
-        return self.synth is not None and self.player.status() == fluidsynth.Player.PLAYING
+        return self.player is not None and self.player.status() == self.playing
     def next(self):
         active = self.active()
         a = self.synth.get_samples(240)
         if active and a.size > 0:
             return (a[::2] + a[1::2]).tobytes()
         return None
-    def set_soundfont(self, sf):
-        if self.synth:
-            oldid = self.sfid
-            self.synth.sfunload(oldid, True)
-            self.sfid = self.synth.sfload(sf, True)
     def stop(self):
-        if self.synth:
+        if self.player:
             self.player.stop()
             self.player.delete()
             self.player = None
-            self.synth.delete()
-            self.synth = None
+            self.synth.system_reset()
 
 
 class MumbleBot:
-    def __init__(self, args):
-        signal.signal(signal.SIGINT, self.ctrl_caught)
-        self.volume = var.db.getfloat('bot', 'volume', fallback=0.5)
-        self.soundfont = var.db.get('bot', 'soundfont', fallback=None)
-
-        FORMAT = '%(asctime)s: %(message)s'
-        loglevel = logging.INFO
-        if args.verbose:
-            loglevel = logging.DEBUG
-        elif args.quiet:
-            loglevel = logging.ERROR
-        logfile = var.config.get('bot', 'logfile')
-        if logfile:
-            logging.basicConfig(filename=logfile, format=FORMAT, level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
-        else:
-            logging.basicConfig(format=FORMAT, level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
-        if args.verbose:
-            logging.debug("Starting in DEBUG loglevel")
-        elif args.quiet:
-            logging.error("Starting in ERROR loglevel")
-        else:
-            logging.info("Starting in INFO loglevel")
-
-        var.playlist = []
+    def __init__(self, args, name=None):
+        # name is None when a single bot runs in the process, otherwise the
+        # [instance:name] section of the configuration overrides [server]/[bot]
+        self.name = name
+        self.db_section = 'bot' if name is None else 'instance:' + name
+        if not var.db.has_section(self.db_section):
+            var.db.add_section(self.db_section)
+        self.volume = var.db.getfloat(self.db_section, 'volume', fallback=0.5)
+        self.soundfont = var.db.get(self.db_section, 'soundfont', fallback=None)
+        self.synth = None
+        self.synth_soundfont = None
+        self.synth_sfid = None
+        self.synth_lock = threading.Lock()
+
+        # the web interface waits on `changed` for a new state `version`
+        self.version = 0
+        self.changed = threading.Condition()
+        self.playlist = media.playlist.Playlist(self.notify_change)
 
-        var.user = args.user
-        var.music_folder = var.config.get('bot', 'music_folder')
-        var.is_proxified = var.config.getboolean("webinterface", "is_web_proxified")
         self.exit = False
-        self.nb_exit = 0
         self.music_source = None
         self.is_playing = False
+        self.track_gain = 1.0
+        self.prepare_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.preparing = None
+        self.prepare_generation = 0
+        self.resume_position = None  # where the current track restarts, None for a new track
+        self.search_results = {}  # user -> results of their last !search
+        self.mixer = None  # created with the first sound effect
+        self.resolve_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.resolving_lock = threading.Lock()
+        self.resolving = {}  # id of a playlist placeholder -> future of its resolution
+        self.last_resolve_ahead = 0
+        self.idle_since = None  # since when nobody listens
+        self.suspended = False
         self.work_queue_lock = threading.Lock()
         self.work_queue = []
+        self.buffer = jitter.AdaptiveBuffer(var.config.getfloat('bot', 'buffer_min'),
+                                            var.config.getfloat('bot', 'buffer_max'),
+                                            name='buffer' if name is None else 'buffer.' + name)
 
-        if var.config.getboolean("webinterface", "enabled"):
-            wi_addr = var.config.get("webinterface", "listening_addr")
-            wi_port = var.config.getint("webinterface", "listening_port")
-            interface.init_proxy()
-            tt = threading.Thread(target=start_web_interface, args=(wi_addr, wi_port))
-            tt.daemon = True
-            tt.start()
+        # command line arguments only apply to the single bot mode
+        if name is not None:
+            args = argparse.Namespace(host=None, port=None, password=None, channel=None,
+                                      certificate=None, tokens=None, user=None)
 
         if args.host:
             host = args.host
         else:
-            host = var.config.get("server", "host")
+            host = self.get_option("server", "host")
 
         if args.port:
             port = args.port
         else:
-            port = var.config.getint("server", "port")
+            port = int(self.get_option("server", "port"))
 
         if args.password:
             password = args.password
         else:
-            password = var.config.get("server", "password")
+            password = self.get_option("server", "password")
 
         if args.channel:
             self.channel = args.channel
         else:
-            self.channel = var.config.get("server", "channel")
+            self.channel = self.get_option("server", "channel")
 
         if args.certificate:
             certificate = args.certificate
         else:
-            certificate = var.config.get("server", "certificate")
+            certificate = self.get_option("server", "certificate")
 
         if args.tokens:
             tokens = args.tokens
         else:
-            tokens = var.config.get("server", "tokens")
+            tokens = self.get_option("server", "tokens")
             tokens = tokens.split(',')
 
         if args.user:
             self.username = args.user
         else:
-            self.username = var.config.get("bot", "username")
+            self.username = self.get_option("bot", "username")
 
         self.mumble = pymumble.Mumble(host, user=self.username, port=port, password=password, tokens=tokens,
-                                      debug=var.config.getboolean('debug', 'mumbleConnection'), certfile=args.certificate)
+                                      debug=var.config.getboolean('debug', 'mumbleConnection'), certfile=certificate or None)
+        # created before the callbacks, commands may be answered as soon as we connect
+        self.outbox = outbox.Outbox(self.mumble,
+                                    window=var.config.getfloat('bot', 'message_window'),
+                                    rate=var.config.getfloat('bot', 'message_rate'),
+                                    burst=var.config.getint('bot', 'message_burst'))
         self.mumble.callbacks.set_callback(pymumble.constants.PYMUMBLE_CLBK_TEXTMESSAGERECEIVED, self.message_received)
+        for callback in [pymumble.constants.PYMUMBLE_CLBK_USERCREATED, pymumble.constants.PYMUMBLE_CLBK_USERUPDATED,
+                         pymumble.constants.PYMUMBLE_CLBK_USERREMOVED]:
+            self.mumble.callbacks.set_callback(callback, self.users_changed)
 
-        self.mumble.set_codec_profile("audio")
+        self.mumble.set_codec_profile(self.get_option('bot', 'codec_profile'))
         self.mumble.start()  # start the mumble thread
         self.mumble.is_ready()  # wait for the connection
         self.set_comment()
         self.mumble.users.myself.unmute()  # by sure the user is not muted
         if self.channel:
             self.mumble.channels.find_by_name(self.channel).move_in()
-        self.mumble.set_bandwidth(200000)
-
-        self.loop()
-
-    def ctrl_caught(self, signal, frame):
-        logging.info("\nSIGINT caught, quitting, {} more to kill".format(2 - self.nb_exit))
-        self.exit = True
-        self.stop_all()
-        if self.nb_exit > 1:
-            logging.info("Forced Quit")
-            sys.exit(0)
-        self.nb_exit += 1
+        self.bandwidth = bandwidth.BandwidthManager(self)
+        self.bandwidth.update()
+        self.opus_output = media.opus.OpusOutput(self.mumble)
+        self.opus_output.on_packet = self.bandwidth.packet_sent
+        self.users_changed()
+
+    def apply_config(self):
+        # options read once at startup by the bot's components
+        self.outbox.window = var.config.getfloat('bot', 'message_window')
+        self.outbox.rate = var.config.getfloat('bot', 'message_rate')
+        self.outbox.burst = var.config.getint('bot', 'message_burst')
+        self.buffer.min_size = var.config.getfloat('bot', 'buffer_min')
+        self.buffer.max_size = max(self.buffer.min_size, var.config.getfloat('bot', 'buffer_max'))
+        self.queue_work(self.bandwidth.update)
+
+    def get_option(self, section, option):
+        if self.name is not None and var.config.has_option('instance:' + self.name, option):
+            return var.config.get('instance:' + self.name, option)
+        return var.config.get(section, option)
 
     def queue_work(self, func):
         future = Future()
@@ -220,11 +276,12 @@ class MumbleBot:
         return future
 
     def message_received(self, text):
+        config = var.config
         message = text.message.strip()
         user = self.mumble.users[text.actor]['name']
-        if var.config.getboolean('command', 'split_username_at_space'):
+        if config.split_username_at_space:
             user = user.split()[0]
-        if message[0] == var.config.get('command', 'command_symbol'):
+        if message[:1] == config.command_symbol:
             message = message[1:].split(' ', 1)
             if len(message) > 0:
                 command = message[0]
@@ -236,118 +293,157 @@ class MumbleBot:
                 return
 
             logging.info(command + ' - ' + parameter + ' by ' + user)
+            # from here on, command is the name of the command option
+            command = config.commands.get(command)
+            if command is None:
+                return
 
-            if command == var.config.get('command', 'joinme'):
+            if command == 'joinme':
                 self.mumble.users.myself.move_in(self.mumble.users[text.actor]['channel_id'], token=parameter)
                 return
 
-            if not self.is_admin(user) and not var.config.getboolean('bot', 'allow_other_channel_message') and self.mumble.users[text.actor]['channel_id'] != self.mumble.users.myself['channel_id']:
-                self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_in_my_channel'))
+            if not self.is_admin(user, config) and not config.getboolean('bot', 'allow_other_channel_message') and self.mumble.users[text.actor]['channel_id'] != self.mumble.users.myself['channel_id']:
+                self.send_user_msg(text.actor, config.get('strings', 'not_in_my_channel'))
                 return
 
-            if not self.is_admin(user) and not var.config.getboolean('bot', 'allow_private_message') and text.session:
-                self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'pm_not_allowed'))
+            if not self.is_admin(user, config) and not config.getboolean('bot', 'allow_private_message') and text.session:
+                self.send_user_msg(text.actor, config.get('strings', 'pm_not_allowed'))
                 return
 
             for i in var.db.items("user_ban"):
                 if user.lower() == i[0]:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'user_ban'))
+                    self.send_user_msg(text.actor, config.get('strings', 'user_ban'))
                     return
 
-            if command == var.config.get('command', 'user_ban'):
-                if self.is_admin(user):
+            if command == 'user_ban':
+                if self.is_admin(user, config):
                     if parameter:
-                        self.mumble.users[text.actor].send_text_message(util.user_ban(parameter))
+                        self.send_user_msg(text.actor, util.user_ban(parameter))
                     else:
-                        self.mumble.users[text.actor].send_text_message(util.get_user_ban())
+                        self.send_user_msg(text.actor, util.get_user_ban())
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
                 return
 
-            elif command == var.config.get('command', 'user_unban'):
-                if self.is_admin(user):
+            elif command == 'user_unban':
+                if self.is_admin(user, config):
                     if parameter:
-                        self.mumble.users[text.actor].send_text_message(util.user_unban(parameter))
+                        self.send_user_msg(text.actor, util.user_unban(parameter))
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
                 return
 
-            elif command == var.config.get('command', 'url_ban'):
-                if self.is_admin(user):
+            elif command == 'url_ban':
+                if self.is_admin(user, config):
                     if parameter:
-                        self.mumble.users[text.actor].send_text_message(util.url_ban(self.get_url_from_input(parameter)))
+                        self.send_user_msg(text.actor, util.url_ban(self.get_url_from_input(parameter)))
                     else:
-                        self.mumble.users[text.actor].send_text_message(util.get_url_ban())
+                        self.send_user_msg(text.actor, util.get_url_ban())
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
                 return
 
-            elif command == var.config.get('command', 'url_unban'):
-                if self.is_admin(user):
+            elif command == 'url_unban':
+                if self.is_admin(user, config):
                     if parameter:
-                        self.mumble.users[text.actor].send_text_message(util.url_unban(self.get_url_from_input(parameter)))
+                        self.send_user_msg(text.actor, util.url_unban(self.get_url_from_input(parameter)))
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
                 return
 
             if parameter:
                 for i in var.db.items("url_ban"):
                     if self.get_url_from_input(parameter.lower()) == i[0]:
-                        self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'url_ban'))
+                        self.send_user_msg(text.actor, config.get('strings', 'url_ban'))
                         return
 
-            if command == var.config.get('command', 'play_file') and parameter:
-                music_folder = var.config.get('bot', 'music_folder')
-                filenames = self.find_file(music_folder, parameter, multiple='*' in parameter)
+            if command == 'play_file' and parameter:
+                music_folder = config.get('bot', 'music_folder')
+                filenames = self.find_file(music_folder, parameter, multiple='*' in parameter, config=config)
+                room = self.get_queue_room(user, config)
+                if room is not None and len(filenames) > room:
+                    metrics.incr('quota.rejected.queue')
+                    self.send_user_msg(text.actor, config.get('strings', 'user_queue_full') % config.getint('bot', 'max_user_queue'))
+                    filenames = filenames[:room]
                 for filename in filenames:
-                    music = {'type': 'file',
-                             'path': filename,
-                             'user': user,
-                             'start': 0,
-                             'end': 0}
-                    pos = self.queue_work(lambda: (var.playlist.append(music) or len(var.playlist))).wait()
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'file_queued') % (filename, pos))
-
-            elif command == var.config.get('command', 'play_url') and parameter:
-                self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'download_in_progress') % parameter)
-                entries = media.url.get_url_info(self.get_url_from_input(parameter), user)
-                self.play_urls(entries, text, user)
-
-            elif command == var.config.get('command', 'play_playlist') and parameter:
-                offset = 1
-                try:
-                    offset = int(parameter.split(" ")[-1])
-                except ValueError:
-                    pass
-                musics = media.playlist.get_playlist_info(url=self.get_url_from_input(parameter), start_index=offset, user=user)
-                if musics:
-                    self.play_urls(musics, text, user)
-
-            elif command == var.config.get('command', 'play_radio') and parameter:
-                if var.config.has_option('radio', parameter):
-                    parameter = var.config.get('radio', parameter)
+                    music = media.file.get_music(filename, user)
+                    if music.get('duration', 0) > config.getint('bot', 'max_track_duration'):
+                        self.send_user_msg(text.actor, config.get('strings', 'too_long'))
+                        continue
+                    pos = self.queue_work(lambda: (self.playlist.append(music) or len(self.playlist))).wait()
+                    self.send_user_msg(text.actor, config.get('strings', 'file_queued') % (media.file.get_title(music), pos))
+
+            elif command == 'play_url' and parameter:
+                def request():
+                    self.send_user_msg(text.actor, config.get('strings', 'download_in_progress') % parameter)
+                    entries = media.url.get_url_info(self.get_url_from_input(parameter), user)
+                    self.play_urls(entries, text, user, config)
+                self.run_request(text, user, request, config)
+
+            elif command == 'play_playlist' and parameter:
+                def request():
+                    offset = 1
+                    try:
+                        offset = int(parameter.split(" ")[-1])
+                    except ValueError:
+                        pass
+                    musics = media.playlist.get_playlist_info(url=self.get_url_from_input(parameter), start_index=offset, user=user)
+                    if musics:
+                        self.play_urls(musics, text, user, config)
+                self.run_request(text, user, request, config)
+
+            elif command == 'play_radio' and parameter:
+                if config.has_option('radio', parameter):
+                    parameter = config.get('radio', parameter)
                 music = {'type': 'radio',
                          'url': self.get_url_from_input(parameter),
                          'user': user}
-                pos = self.queue_work(lambda: (var.playlist.append(music) or len(var.playlist))).wait()
-                self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'file_queued') % (music['url'], pos))
+                pos = self.queue_work(lambda: (self.playlist.append(music) or len(self.playlist))).wait()
+                self.send_user_msg(text.actor, config.get('strings', 'file_queued') % (music['url'], pos))
 
-            elif command == var.config.get('command', 'help'):
-                self.send_msg(var.config.get('strings', 'help'))
+            elif command == 'help':
+                self.send_msg(config.get('strings', 'help'))
 
-            elif command == var.config.get('command', 'stop'):
+            elif command == 'stop':
                 self.queue_work(self.stop_all)
 
-            elif command == var.config.get('command', 'kill'):
-                if self.is_admin(user):
+            elif command == 'kill':
+                if self.is_admin(user, config):
                     self.queue_work(self.quit())
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
 
-            elif command == var.config.get('command', 'update'):
-                if self.is_admin(user):
-                    self.mumble.users[text.actor].send_text_message("Starting the update")
-                    tp = sp.check_output([var.config.get('bot', 'pip3_path'), 'install', '--upgrade', 'youtube-dl']).decode()
+            elif command == 'reload':
+                if self.is_admin(user, config):
+                    try:
+                        settings.reload()
+                    except Exception as e:
+                        logging.error('Could not reload the configuration: {}'.format(e))
+                        self.send_user_msg(text.actor, config.get('strings', 'config_reload_error'))
+                    else:
+                        for bot in var.bots:
+                            bot.apply_config()
+                        self.send_user_msg(text.actor, config.get('strings', 'config_reloaded'))
+                else:
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
+
+            elif command == 'stats':
+                if self.is_admin(user, config):
+                    self.print_items(metrics.render())
+                else:
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
+
+            elif command == 'rescan':
+                if self.is_admin(user, config):
+                    files = var.library.refresh()
+                    self.send_user_msg(text.actor, config.get('strings', 'library_rescanned') % len(files))
+                else:
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
+
+            elif command == 'update':
+                if self.is_admin(user, config):
+                    self.send_user_msg(text.actor, "Starting the update")
+                    tp = sp.check_output([config.get('bot', 'pip3_path'), 'install', '--upgrade', 'youtube-dl']).decode()
                     msg = ""
                     if "Requirement already up-to-date" in tp:
                         msg += "Youtube-dl is up-to-date"
@@ -359,18 +455,18 @@ class MumbleBot:
                     else:
                         msg += "<br /> I have available updates"
                         needs_restart = True
-                    self.mumble.users[text.actor].send_text_message(msg)
+                    self.send_user_msg(text.actor, msg)
                     if needs_restart:
                         os.execv(sys.executable, [sys.executable] + sys.argv)
                 else:
-                    self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'not_admin'))
+                    self.send_user_msg(text.actor, config.get('strings', 'not_admin'))
 
-            elif command == var.config.get('command', 'stop_and_getout'):
+            elif command == 'stop_and_getout':
                 self.queue_work(self.stop_all).wait()
                 if self.channel:
                     self.mumble.channels.find_by_name(self.channel).move_in()
 
-            elif command == var.config.get('command', 'volume'):
+            elif command == 'volume':
                 try:
                     volume = float(float(parameter) / 100)
                 except ValueError:
@@ -378,25 +474,25 @@ class MumbleBot:
 
                 if volume is None:
                     volume = self.queue_work(lambda: self.volume).wait()
-                    self.send_msg(var.config.get('strings', 'current_volume') % float(volume * 100))
+                    self.send_msg(config.get('strings', 'current_volume') % float(volume * 100))
                 else:
                     self.queue_work(lambda: self.set_volume(volume))
-                    self.send_msg(var.config.get('strings', 'change_volume') % (
+                    self.send_msg(config.get('strings', 'change_volume') % (
                         float(volume * 100), self.mumble.users[text.actor]['name']))
 
-            elif command == var.config.get('command', 'soundfont'):
+            elif command == 'soundfont':
                 if parameter:
-                    sf_folder = var.config.get('bot', 'soundfont_folder')
-                    filenames = self.find_file(sf_folder, parameter)
+                    sf_folder = config.get('bot', 'soundfont_folder')
+                    filenames = self.find_file(sf_folder, parameter, config=config)
                     if len(filenames) > 0:
                         self.queue_work(lambda: self.set_soundfont(filenames[0]))
-                        self.send_msg(var.config.get('strings', 'change_soundfont') % (
+                        self.send_msg(config.get('strings', 'change_soundfont') % (
                             filenames[0], self.mumble.users[text.actor]['name']))
                 else:
                     soundfont = self.queue_work(lambda: self.soundfont).wait()
-                    self.send_msg(var.config.get('strings', 'current_soundfont') % soundfont)
+                    self.send_msg(config.get('strings', 'current_soundfont') % soundfont)
 
-            elif command == var.config.get('command', 'current_music'):
+            elif command == 'current_music':
                 current = self.queue_work(self.get_current_music).wait()
                 if current:
                     source = current["type"]
@@ -421,44 +517,86 @@ class MumbleBot:
                         )
                     elif source == "file":
                         reply = "[file] {title} by {user}".format(
-                            title=current["path"],
+                            title=media.file.get_title(current),
                             user=current["user"])
                     else:
                         reply = "ERROR"
                         logging.error(current)
                 else:
-                    reply = var.config.get('strings', 'not_playing')
+                    reply = config.get('strings', 'not_playing')
 
                 self.send_msg(reply)
 
-            elif command == var.config.get('command', 'skip'):
+            elif command == 'skip':
                 count = 1
                 if parameter is not None and parameter.isdigit() and int(parameter) > 0:
                     count = int(parameter)
-                while count > 0:
-                    if self.queue_work(self.next).wait():
-                        count -= 1
-                    else:
-                        self.queue_work(self.stop_all).wait()
-                        self.send_msg(var.config.get('strings', 'queue_empty'))
-                        return
+                if not self.queue_work(lambda: self.skip(count)).wait():
+                    self.send_msg(config.get('strings', 'queue_empty'))
+
+            elif command == 'move':
+                try:
+                    src, dst = [int(i) for i in parameter.split()]
+                except ValueError:
+                    self.send_user_msg(text.actor, config.get('strings', 'bad_parameter') % self.print_cmd('help', config))
+                    return
+                if self.queue_work(lambda: self.move_item(src, dst)).wait():
+                    self.send_msg(config.get('strings', 'item_moved') % (src, dst, user))
+                else:
+                    self.send_user_msg(text.actor, config.get('strings', 'no_possible'))
+
+            elif command == 'remove':
+                try:
+                    bounds = [int(i) for i in parameter.split('-', 1)]
+                except ValueError:
+                    self.send_user_msg(text.actor, config.get('strings', 'bad_parameter') % self.print_cmd('help', config))
+                    return
+                removed = self.queue_work(lambda: self.remove_items(*bounds)).wait()
+                if removed:
+                    self.send_msg(config.get('strings', 'removing_item') % ', '.join(m.get('title') or m.get('path') or m.get('url') for m in removed))
+                else:
+                    self.send_user_msg(text.actor, config.get('strings', 'no_possible'))
+
+            elif command == 'insert':
+                param = parameter.split(' ', 1)
+                if len(param) < 2 or not param[0].isdigit():
+                    self.send_user_msg(text.actor, config.get('strings', 'bad_parameter') % self.print_cmd('help', config))
+                    return
+                music_folder = config.get('bot', 'music_folder')
+                filenames = self.find_file(music_folder, param[1], multiple='*' in param[1], config=config)
+                musics = [media.file.get_music(filename, user) for filename in filenames]
+                musics = [music for music in musics
+                          if music.get('duration', 0) <= config.getint('bot', 'max_track_duration')]
+                if len(musics) < len(filenames):
+                    self.send_user_msg(text.actor, config.get('strings', 'too_long'))
+                if musics:
+                    pos = self.queue_work(lambda: self.insert_items(int(param[0]), musics)).wait()
+                    self.send_user_msg(text.actor, config.get('strings', 'file_queued') % (', '.join(media.file.get_title(m) for m in musics), pos))
+
+            elif command == 'dedupe':
+                removed = self.queue_work(self.dedupe).wait()
+                self.send_msg(config.get('strings', 'queue_deduped') % removed)
 
-            elif command == var.config.get('command', 'list'):
-                folder_path = var.config.get('bot', 'music_folder')
+            elif command == 'list':
+                folder_path = config.get('bot', 'music_folder')
 
-                files = self.find_file(folder_path, parameter or '*', multiple=True)
+                files = self.find_file(folder_path, parameter or '*', multiple=True, config=config)
                 self.print_items(files);
 
-            elif command == var.config.get('command', 'list_soundfonts'):
-                folder_path = var.config.get('bot', 'soundfont_folder')
+            elif command == 'sfx' and parameter:
+                sfx_folder = config.get('bot', 'sfx_folder')
+                filenames = self.find_file(sfx_folder, parameter, config=config)
+                if filenames:
+                    self.queue_work(lambda: self.play_effect(os.path.join(sfx_folder, filenames[0])))
 
-                files = util.get_recursive_filelist_sorted(folder_path, False)
+            elif command == 'list_soundfonts':
+                files = var.soundfonts.get_catalog()
                 if files:
                     self.send_msg('<br>'.join(files))
                 else:
-                    self.send_msg(var.config.get('strings', 'folder_empty'))
+                    self.send_msg(config.get('strings', 'folder_empty'))
 
-            elif command == var.config.get('command', 'midi') and parameter:
+            elif command == 'midi' and parameter:
                 if self.music_source and isinstance(self.music_source, MusicSourceFluidSynth):
                     player = self.music_source.player
                     midi_param = parameter.split(' ', 1)
@@ -490,12 +628,12 @@ class MumbleBot:
                     self.send_msg('No midi playing!')
 
 
-            elif command == var.config.get('command', 'queue'):
-                playlist = self.queue_work(lambda: [m.copy() for m in var.playlist]).wait()
+            elif command == 'queue':
+                playlist = self.queue_work(lambda: [m.copy() for m in self.playlist]).wait()
                 if len(playlist) <= 1:
-                    msg = var.config.get('strings', 'queue_empty')
+                    msg = config.get('strings', 'queue_empty')
                 else:
-                    msg = var.config.get('strings', 'queue_contents') + '<br />'
+                    msg = config.get('strings', 'queue_contents') + '<br />'
                     i = 1
                     for value in playlist[1:]:
                         msg += '[{}] ({}) {}<br />'.format(i, value['type'], value['title'] if 'title' in value else value['path'])
@@ -503,70 +641,113 @@ class MumbleBot:
 
                 self.send_msg(msg)
 
-            elif command == var.config.get('command', 'repeat'):
-                self.queue_work(lambda: var.playlist.append(var.playlist[0]) if len(var.playlist) > 0 else None)
+            elif command == 'repeat':
+                self.queue_work(lambda: self.playlist.append(self.playlist[0]) if len(self.playlist) > 0 else None)
 
-            elif command == var.config.get('command', 'search'):
-                if str(parameter) == '':
-                    self.send_msg(var.config.get('strings', 'search_error') % parameter)
-                    return
-                self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'search_for') % parameter)
-                try:
-                    entries = media.url.search(parameter, user)
-                except Exception as e:
-                    logging.debug(e)
-                    self.send_msg(var.config.get('strings', 'search_error') % parameter)
-                    return
-                if len(entries) == 0:
-                    self.send_msg(var.config.get('strings', 'no_search_results') % parameter)
-                    return
-                self.play_urls(entries, text, user)
+            elif command == 'search':
+                def request():
+                    if str(parameter) == '':
+                        self.send_msg(config.get('strings', 'search_error') % parameter)
+                        return
+                    self.send_user_msg(text.actor, config.get('strings', 'search_for') % parameter)
+                    try:
+                        results = media.url.search(parameter, config.getint('bot', 'search_results'))
+                    except Exception as e:
+                        logging.debug(e)
+                        results = None
+                    if results is None:
+                        self.send_msg(config.get('strings', 'search_error') % parameter)
+                        return
+                    if len(results) == 0:
+                        self.send_msg(config.get('strings', 'no_search_results') % parameter)
+                        return
+                    if len(results) == 1:
+                        self.play_urls(media.url.get_url_info(results[0]['url'], user), text, user)
+                        return
+                    # kept for !pick, only the chosen result is resolved
+                    self.search_results[user] = results
+                    self.send_user_msg(text.actor, config.get('strings', 'search_results') % (parameter, self.print_cmd('pick', config)))
+                    for i, result in enumerate(results):
+                        self.send_user_msg(text.actor, '[{}] {} ({}:{:02d})'.format(
+                            i + 1, result['title'], int(result['duration']), int(result['duration'] * 60) % 60))
+                self.run_request(text, user, request, config)
+
+            elif command == 'pick':
+                def request():
+                    results = self.search_results.get(user)
+                    if not results:
+                        self.send_user_msg(text.actor, config.get('strings', 'no_search') % self.print_cmd('search', config))
+                        return
+                    if not parameter.isdigit() or not 0 < int(parameter) <= len(results):
+                        self.send_user_msg(text.actor, config.get('strings', 'bad_parameter') % self.print_cmd('help', config))
+                        return
+                    url = results[int(parameter) - 1]['url']
+                    self.send_user_msg(text.actor, config.get('strings', 'download_in_progress') % url)
+                    self.play_urls(media.url.get_url_info(url, user), text, user)
+                self.run_request(text, user, request, config)
 
             #else:
-                #help_cmd = self.print_cmd('help')
-                #self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'bad_command') % (command, help_cmd))
+                #help_cmd = self.print_cmd('help', config)
+                #self.send_user_msg(text.actor, config.get('strings', 'bad_command') % (command, help_cmd))
 
     def print_items(self, items):
+        # the outbox packs the items into as few messages as possible
         maxlen = self.mumble.get_max_message_length() - 1
-
-        if len(items):
-            sent = 0
-            while sent < len(items):
-                msg = items[sent]
-                if len(msg) > maxlen:
-                    msg = msg[0:maxlen-3]+'...'
-                    sent += 1
-                else:
-                    while True:
-                        sent += 1
-                        if sent >= len(items):
-                            break
-                        nextstr = '<br>' + items[sent]
-                        if len(nextstr) + len(msg) > maxlen:
-                            break
-                        msg += nextstr
-                self.send_msg(msg)
-
-    def print_cmd(self, cmd):
-        return var.config.get('command', 'command_symbol') + var.config.get('command', cmd)
-
-    def play_urls(self, entries, text, user):
+        for msg in items:
+            if 0 < maxlen < len(msg):
+                msg = msg[0:maxlen-3]+'...'
+            self.send_msg(msg)
+
+    def print_cmd(self, cmd, config=None):
+        config = config or var.config
+        return config.get('command', 'command_symbol') + config.get('command', cmd)
+
+    def run_request(self, text, user, func, config=None):
+        # expensive commands (youtube-dl) go through the admission layer
+        config = config or var.config
+        status, value = quota.submit(user, self.is_admin(user, config), func, config)
+        if status == 'deferred':
+            self.send_user_msg(text.actor, config.get('strings', 'request_deferred') % value)
+        elif status == 'rate':
+            self.send_user_msg(text.actor, config.get('strings', 'request_rate') % value)
+        elif status == 'busy':
+            self.send_user_msg(text.actor, config.get('strings', 'request_busy'))
+
+    def get_queue_room(self, user, config=None):
+        """Number of entries the user may still queue, None if unlimited."""
+        config = config or var.config
+        limit = config.getint('bot', 'max_user_queue')
+        if limit <= 0 or self.is_admin(user, config):
+            return None
+        queued = self.queue_work(lambda: sum(1 for m in self.playlist if m.get('user') == user)).wait()
+        return max(0, limit - queued)
+
+    def play_urls(self, entries, text, user, config=None):
+        config = config or var.config
         if entries:
+            room = self.get_queue_room(user, config)
             for music in entries:
-                if music['duration'] > var.config.getint('bot', 'max_track_duration'):
-                    self.send_msg(var.config.get('strings', 'too_long'))
+                if room is not None and room <= 0:
+                    metrics.incr('quota.rejected.queue')
+                    self.send_user_msg(text.actor, config.get('strings', 'user_queue_full') % config.getint('bot', 'max_user_queue'))
+                    return
+                if music['duration'] > config.getint('bot', 'max_track_duration'):
+                    self.send_msg(config.get('strings', 'too_long'))
                 else:
                     for i in var.db.options("url_ban"):
                         if music['url'] == i:
-                            self.send_msg(var.config.get('strings', 'url_ban'))
+                            self.send_msg(config.get('strings', 'url_ban'))
                             return
-                    pos = self.queue_work(lambda: (var.playlist.append(music) or len(var.playlist))).wait()
+                    if room is not None:
+                        room -= 1
+                    pos = self.queue_work(lambda: (self.playlist.append(music) or len(self.playlist))).wait()
                     if pos > 1:
-                        self.mumble.users[text.actor].send_text_message(var.config.get('strings', 'file_queued') % (music['title'], pos))
+                        self.send_user_msg(text.actor, config.get('strings', 'file_queued') % (music['title'], pos))
         else:
-            self.send_msg(var.config.get('strings', 'bad_url'))
+            self.send_msg(config.get('strings', 'bad_url'))
 
-    def find_file(self, folder, parameter, multiple=False):
+    def find_file(self, folder, parameter, multiple=False, config=None):
+        config = config or var.config
         # sanitize "../" and so on
         path = os.path.abspath(os.path.join(folder, parameter or ''))
         if path.startswith(folder):
@@ -578,75 +759,203 @@ class MumbleBot:
                     matches = [file.replace(folder, '') for file in glob.glob(os.path.join(folder, '**', parameter), recursive=True)]
                     matches.sort()
                 else:
-                    matches = [file for file in util.get_recursive_filelist_sorted(folder, False) if parameter.lower() in file.lower()]
+                    if folder == var.music_folder:
+                        files = var.library.get_files()
+                    elif folder == var.soundfonts.folder:
+                        files = var.soundfonts.get_catalog()
+                    else:
+                        files = util.get_recursive_filelist_sorted(folder, False)
+                    matches = [file for file in files if parameter.lower() in file.lower()]
                 if len(matches) == 0:
-                    self.send_msg(var.config.get('strings', 'no_file'))
+                    self.send_msg(config.get('strings', 'no_file'))
                     return []
                 elif len(matches) == 1 or multiple:
                     return matches
                 else:
-                    msg = var.config.get('strings', 'multiple_matches') + '<br />'
+                    msg = config.get('strings', 'multiple_matches') + '<br />'
                     msg += '<br />'.join(matches)
                     self.send_msg(msg)
                     return []
         else:
-            self.send_msg(var.config.get('strings', 'bad_file'))
+            self.send_msg(config.get('strings', 'bad_file'))
             return []
 
     def get_current_music(self):
-        if len(var.playlist) > 0:
-            return var.playlist[0].copy()
+        if len(self.playlist) > 0:
+            return self.playlist[0].copy()
         return None
 
+    def notify_change(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
     def set_volume(self, volume):
+        if self.music_source and not self.music_source.passthrough:
+            # apply the change to the audio already queued, with a short ramp
+            old_gain = self.volume * self.track_gain
+            if old_gain > 0:
+                media.output.set_gain(self.mumble.sound_output, volume * self.track_gain / old_gain,
+                                      var.config.getfloat('bot', 'fade_duration'))
+            else:
+                media.output.fade_out(self.mumble.sound_output, 0)
+            if self.music_source.scaled:
+                self.music_source.set_gain(volume * self.track_gain)
         self.volume = volume
-        var.db.set('bot', 'volume', str(volume))
+        var.db.set(self.db_section, 'volume', str(volume))
+        self.notify_change()
+        if self.music_source and self.music_source.passthrough and not self.can_passthrough(self.track_gain):
+            # the packets can't be scaled, restart the track on the PCM path where it is
+            self.resume_position = self.music_source.position
+            self.stop_current()
+
+    def can_passthrough(self, track_gain):
+        # packets can't be scaled nor mixed
+        if self.mixer and self.mixer.effects:
+            return False
+        return abs(self.volume * track_gain - 1.0) < 0.01
+
+    def play_effect(self, path):
+        # mixed over the music, which is ducked meanwhile
+        if self.mixer is None:
+            self.mixer = media.mixer.Mixer(var.config.getfloat('bot', 'duck_level'),
+                                           var.config.getfloat('bot', 'duck_attack'),
+                                           var.config.getfloat('bot', 'duck_release'))
+        source = MusicSourceSubprocess(sp.Popen(["ffmpeg", '-v', 'warning', '-nostdin', '-i', path, '-ac', '2',
+                                                 '-f', 's16le', '-ar', '48000', '-'], stdout=sp.PIPE, bufsize=480))
+        self.mixer.add(source, self.volume * var.config.getfloat('bot', 'sfx_gain'))
+        if self.music_source and self.music_source.passthrough:
+            # continue the track on the PCM path where it is
+            self.resume_position = self.music_source.position
+            self.stop_current()
 
     def set_soundfont(self, sf):
         self.soundfont = sf
-        var.db.set('bot', 'soundfont', str(sf))
+        var.db.set(self.db_section, 'soundfont', str(sf))
         sf_folder = var.config.get('bot', 'soundfont_folder')
-        sf = os.path.join(sf_folder, sf)
-        self.queue_work(lambda: self.music_source.set_soundfont(sf) if self.music_source else None)
+        path = os.path.join(sf_folder, sf)
+        # load in the background, the switch itself is then fast
+        var.soundfonts.preload(path, lambda: self.queue_work(lambda: self.switch_soundfont(path)))
+
+    def switch_soundfont(self, path):
+        if self.synth and self.soundfont and path == os.path.join(var.config.get('bot', 'soundfont_folder'), self.soundfont):
+            self.get_synth(path)
+
+    def get_synth(self, soundfont):
+        # persistent synth of this bot, with the requested soundfont loaded
+        with self.synth_lock:
+            if self.synth is None:
+                self.synth = var.soundfonts.new_synth()
+            if self.synth_soundfont != soundfont:
+                sfid = var.soundfonts.load(self.synth, soundfont, True)
+                if sfid < 0:
+                    # keep the soundfont loaded until now
+                    return self.synth
+                if self.synth_sfid is not None:
+                    self.synth.sfunload(self.synth_sfid, True)
+                self.synth_soundfont, self.synth_sfid = soundfont, sfid
+            return self.synth
 
     @staticmethod
-    def is_admin(user):
-        list_admin = var.config.get('bot', 'admin').split(';')
-        if user in list_admin:
-            return True
-        else:
-            return False
+    def is_admin(user, config=None):
+        return user in (config or var.config).admins
 
     def next(self):
         logging.debug("Next into the queue")
         self.stop_current()
-        if len(var.playlist) > 1:
-            var.playlist.pop(0)
+        self.resume_position = None
+        if len(self.playlist) > 1:
+            self.playlist.pop(0)
             return True
-        elif len(var.playlist) == 1:
-            var.playlist.pop(0)
+        elif len(self.playlist) == 1:
+            self.playlist.pop(0)
             return False
         else:
             return False
 
-    def launch_music(self, music):
+    # Queue operations. They run on the audio loop (through queue_work) so
+    # each one is applied in one step; indexes are the positions shown by
+    # !queue, 1 being the next track.
+
+    def skip(self, count=1):
+        """Skip the current track and the count - 1 next ones, stopping the decoder once."""
+        self.stop_current()
+        self.resume_position = None
+        self.flush_output()
+        if count >= len(self.playlist):
+            self.playlist.clear()
+            return False
+        del self.playlist[:count]
+        return True
+
+    def move_item(self, src, dst):
+        upcoming = self.playlist[1:]
+        if not (0 < src <= len(upcoming) and 0 < dst <= len(upcoming)):
+            return False
+        upcoming.insert(dst - 1, upcoming.pop(src - 1))
+        self.playlist[1:] = upcoming
+        return True
+
+    def remove_items(self, start, end=None):
+        """Remove the entries start to end (included), returns them."""
+        if end is None:
+            end = start
+        end = min(end, len(self.playlist) - 1)
+        if start < 1 or end < start:
+            return []
+        removed = self.playlist[start:end + 1]
+        del self.playlist[start:end + 1]
+        return removed
+
+    def insert_items(self, index, items):
+        """Insert items before the entry at index, returns the index used."""
+        index = max(1, min(index, len(self.playlist))) if self.playlist else 0
+        self.playlist[index:index] = items
+        return index
+
+    def dedupe(self):
+        """Remove the entries already in the queue, returns the number removed."""
+        seen = set()
+        upcoming = []
+        for i, music in enumerate(self.playlist):
+            key = (music['type'], music.get('url') or music.get('path'))
+            if i > 0 and key not in seen:
+                upcoming.append(music)
+            seen.add(key)
+        removed = max(0, len(self.playlist) - 1 - len(upcoming))
+        if removed:
+            self.playlist[1:] = upcoming
+        return removed
+
+    def prepare_music(self, music, position=0, announce=True):
+        # Runs on the preparation worker: everything that may block (network
+        # probes, tags, thumbnails, spawning the decoder) happens here, and the
+        # source is handed to the audio loop once it can produce samples.
         uri = ""
-        logging.debug("launch_music asked" + str(music))
+        logging.debug("prepare_music asked" + str(music))
+        track_gain = 1.0
+        if music.get('unresolved'):
+            if not self.resolve_entry(music).result():
+                self.send_msg(var.config.get('strings', 'unable_download') % music['url'])
+                return None
+            if music['duration'] > var.config.getint('bot', 'max_track_duration'):
+                self.send_msg(var.config.get('strings', 'too_long'))
+                return None
         if music["type"] == "url":
 
             if 'path' not in music:
-                return False
+                return None
 
             uri = music['path']
-            if os.path.isfile(uri):
-                audio = EasyID3(uri)
-                title = ""
-                if audio["title"]:
-                    title = audio["title"][0]
+            if announce and os.path.isfile(uri):
+                tags = media.file.read_tags(uri) or {}
+                title = tags.get('title', music.get('title', ''))
 
                 path_thumbnail = music['path'][:-4] + '.jpg'  # Remove .mp3 and add .jpg
                 thumbnail_html = ""
                 if os.path.isfile(path_thumbnail):
+                    from PIL import Image
+                    from io import BytesIO
                     im = Image.open(path_thumbnail)
                     im.thumbnail((100, 100), Image.ANTIALIAS)
                     buffer = BytesIO()
@@ -657,30 +966,60 @@ class MumbleBot:
                 logging.debug("Thumbnail data " + thumbnail_html)
                 if var.config.getboolean('bot', 'announce_current_music'):
                     self.send_msg(var.config.get('strings', 'now_playing') % (title, thumbnail_html))
-            elif 'thumbnail' in music:
+            elif announce and 'thumbnail' in music:
                 if var.config.getboolean('bot', 'announce_current_music'):
                     title = '<a href="%s">%s</a>' % (music['url'], music['title'])
                     #thumbnail_html = '<img src="%s" width="100"/>' % music['thumbnail']
                     thumbnail_html = ""
                     self.send_msg(var.config.get('strings', 'now_playing') % (title, thumbnail_html))
 
+            meta = var.library.get_meta(music['url'])
+            if 'loudness' not in meta:
+                media.loudness.submit(music['url'], uri, is_file=False)
+            track_gain = media.loudness.get_gain(meta)
+
         elif music["type"] == "file":
             uri = var.config.get('bot', 'music_folder') + music["path"]
-            self.send_msg(var.config.get('strings', 'now_playing') % (music['path'], ""))
+            meta = var.library.get_file_meta(music['path'])
+            if 'duration' not in meta:
+                # queued before the tags worker read it
+                tags = media.file.read_tags(uri) or {'duration': 0}
+                var.library.set_file_meta(music['path'], **tags)
+                meta = var.library.get_file_meta(music['path'])
+                music.update(media.file.entry_tags(meta))
+            if meta['duration'] / 60 > var.config.getint('bot', 'max_track_duration'):
+                self.send_msg(var.config.get('strings', 'too_long'))
+                return None
+            if announce:
+                self.send_msg(var.config.get('strings', 'now_playing') % (media.file.get_title(music), ""))
+
+            if 'loudness' not in meta:
+                media.loudness.submit(music['path'], uri)
+            track_gain = media.loudness.get_gain(meta)
 
         elif music["type"] == "radio":
             uri = music["url"]
             title = media.radio.get_radio_server_description(uri)
             music["title"] = title
-            self.send_msg(var.config.get('strings', 'now_playing') % (title or uri, ""))
+            if announce:
+                self.send_msg(var.config.get('strings', 'now_playing') % (title or uri, ""))
 
-        if (music['type'] == 'file' and uri.lower().endswith('.mid')) or music.get('format_id') == 'midi':
+        if self.is_midi(music):
             sf_folder = var.config.get('bot', 'soundfont_folder')
             if not self.soundfont:
                 self.send_msg(var.config.get('strings', 'no_soundfont') % (self.print_cmd('list_soundfonts'), self.print_cmd('soundfont')))
-                return False
+                return None
             soundfont = os.path.join(sf_folder, self.soundfont)
-            self.music_source = MusicSourceFluidSynth(soundfont, uri)
+            content = media.midi.load(uri)
+            cached = media.midi.get_cached(content, soundfont) if content else None
+            if cached:
+                logging.info("Playing rendered MIDI from " + cached)
+                source = MusicSourceSubprocess(sp.Popen(["ffmpeg", '-v', 'warning', '-nostdin', '-i', cached, '-ac', '2',
+                                                         '-f', 's16le', '-ar', '48000', '-'], stdout=sp.PIPE, bufsize=480))
+            else:
+                source = MusicSourceFluidSynth(self.get_synth(soundfont), content)
+                if content:
+                    media.midi.submit_render(content, soundfont)
             #command = ['fluidsynth', '-a', 'file', '-O', 's16', '-T', 'raw', '-iln', '-R', 'no', '-C', 'no', '-F', '-',
                 #soundfont, uri]
             #logging.info("Fluidsynth command : " + " ".join(command))
@@ -693,16 +1032,119 @@ class MumbleBot:
             command = ["ffmpeg", '-v', ffmpeg_debug, '-nostdin']
             if music["type"] != "file":
                     command += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '20']
-            if music['start'] > 0:
-                command += ['-ss', str(music['start'])]
-            if music['end'] > 0:
-                command += ['-to', str(music['end'])]
-            command += ['-i', uri, '-ac', '2', '-vn', '-f', 's16le', '-ar', '48000', '-']
-            logging.info("FFmpeg command : " + " ".join(command))
-            self.music_source = MusicSourceSubprocess(sp.Popen(command, stdout=sp.PIPE, bufsize=480))
+
+            def input_options(start):
+                options = []
+                if start > 0:
+                    options += ['-ss', str(start)]
+                if music.get('end', 0) > 0:
+                    options += ['-to', str(music['end'])]
+                return options + ['-i', uri]
+
+            start = music.get('start', 0) + position
+            output = ['-ac', '2', '-vn', '-f', 's16le', '-ar', '48000', '-']
+            if self.is_passthrough_candidate(music, track_gain):
+                command += input_options(start) + ['-vn', '-map', '0:a:0', '-c:a', 'copy', '-f', 'ogg', '-']
+                logging.info("FFmpeg command (Opus passthrough) : " + " ".join(command))
+                source = MusicSourceOpus(sp.Popen(command, stdout=sp.PIPE), position)
+            elif var.config.getboolean('bot', 'dsp_process'):
+                logging.info("FFmpeg command (worker process) : " + " ".join(command + input_options(start) + output))
+                # restarted `offset` seconds later if the worker dies
+                decoder = media.dsp.Decoder(lambda offset: command + input_options(start + offset) + output,
+                                            gain=self.volume * track_gain,
+                                            slots=int(var.config.getfloat('bot', 'dsp_ring') / 0.02),
+                                            max_restarts=var.config.getint('bot', 'dsp_restarts'),
+                                            seekable=music['type'] != 'radio')
+                source = MusicSourceWorker(decoder, position)
+            else:
+                command += input_options(start) + output
+                logging.info("FFmpeg command : " + " ".join(command))
+                source = MusicSourceSubprocess(sp.Popen(command, stdout=sp.PIPE, bufsize=480), position)
+        return source, track_gain
+
+    @staticmethod
+    def is_midi(music):
+        return (music['type'] == 'file' and music['path'].lower().endswith('.mid')) or music.get('format_id') == 'midi'
+
+    def is_passthrough_candidate(self, music, track_gain):
+        # 48 kHz Opus that fits in our bandwidth, played without gain
+        if not var.config.getboolean('bot', 'opus_passthrough') or music['type'] != 'url':
+            return False
+        if music.get('acodec') != 'opus' or music.get('asr') != 48000 or not self.can_passthrough(track_gain):
+            return False
+        # about 20 kbit/s of protocol overhead with 20 ms packets
+        return (music.get('abr') or 0) * 1000 + 20000 <= self.mumble.sound_output.get_bandwidth()
+
+    def start_preparing(self, music):
+        # a restarted track (passthrough change, resume) isn't announced again
+        future = self.prepare_pool.submit(self.prepare_music, music, self.resume_position or 0,
+                                          self.resume_position is None)
+        self.resume_position = None
+        self.preparing = (self.prepare_generation, future)
+        self.resolve_ahead()
+
+    def resolve_entry(self, music):
+        # playlist placeholders are resolved once, by the first to ask
+        with self.resolving_lock:
+            future = self.resolving.get(id(music))
+            if future is None:
+                future = self.resolve_pool.submit(media.playlist.resolve, music)
+                self.resolving[id(music)] = future
+
+                def done(f):
+                    with self.resolving_lock:
+                        self.resolving.pop(id(music), None)
+                    self.notify_change()
+                future.add_done_callback(done)
+        return future
+
+    def resolve_ahead(self):
+        # resolve the next placeholders so that they start without delay
+        count = var.config.getint('bot', 'playlist_resolve_ahead')
+        for music in self.playlist[1:1 + count]:
+            if music.get('unresolved') and not music.get('resolve_failed'):
+                self.resolve_entry(music)
+
+    def launch_prepared(self):
+        # Called by the audio loop once the preparation is done
+        generation, future = self.preparing
+        self.preparing = None
+        try:
+            prepared = future.result()
+        except Exception as e:
+            logging.error('Could not prepare music: ' + str(e))
+            prepared = None
+        if generation != self.prepare_generation:
+            # skipped or stopped in the meantime
+            if prepared:
+                prepared[0].stop()
+            return True
+        if not prepared:
+            return False
+        self.music_source, self.track_gain = prepared
+        if self.music_source.scaled:
+            # the volume may have changed since it was prepared
+            self.music_source.set_gain(self.volume * self.track_gain)
+        self.buffer.reset()
         self.is_playing = self.music_source.active()
+        self.notify_change()
         return self.is_playing
 
+    def discard_preparing(self):
+        self.prepare_generation += 1
+        if self.preparing:
+            generation, future = self.preparing
+            self.preparing = None
+
+            def discard(f):
+                try:
+                    prepared = f.result()
+                except Exception:
+                    return
+                if prepared:
+                    prepared[0].stop()
+            future.add_done_callback(discard)
+
     @staticmethod
     def get_url_from_input(string):
         if string.startswith('http'):
@@ -726,14 +1168,49 @@ class MumbleBot:
                 except Exception as e:
                     print(e)
 
-            while self.mumble.sound_output.get_buffer_size() > 0.5 and not self.exit:
+            idle_pause = var.config.getfloat('bot', 'idle_pause')
+            if idle_pause > 0 and self.idle_since and not self.suspended and time.time() - self.idle_since > idle_pause:
+                self.suspend()
+            elif self.suspended and idle_pause <= 0:
+                self.resume()
+            if self.suspended:
+                time.sleep(0.1)
+                continue
+
+            if time.time() - self.bandwidth.last_update > 5:
+                # follows channel moves, the schedule and reconnections
+                self.bandwidth.update()
+            if self.is_playing:
+                self.buffer.observe(self.get_buffer_size())
+                if time.time() - self.last_resolve_ahead > 1:
+                    self.last_resolve_ahead = time.time()
+                    self.resolve_ahead()
+            while self.get_buffer_size() > self.buffer.target and not self.exit:
                 time.sleep(0.01)
             if self.music_source:
+                start = time.time()
                 raw_music = self.music_source.next()
-                if raw_music:
-                    self.mumble.sound_output.add_sound(audioop.mul(raw_music, 2, self.volume))
+                if raw_music and self.music_source.passthrough:
+                    self.buffer.delivered(raw_music[1], time.time() - start)
+                    self.opus_output.add_packet(*raw_music)
+                elif raw_music:
+                    self.buffer.delivered(len(raw_music) / 2 / 48000, time.time() - start)
+                    # a worker process already scaled its frames
+                    gain = 1.0 if self.music_source.scaled else self.volume * self.track_gain
+                    if self.mixer and self.mixer.active():
+                        pcm = self.mixer.mix(raw_music, gain)
+                    elif gain == 1.0:
+                        pcm = raw_music
+                    else:
+                        pcm = audioop.mul(raw_music, 2, gain)
+                    if pcm:
+                        self.mumble.sound_output.add_sound(pcm)
                 else:
                     time.sleep(0.1)
+            elif self.mixer and self.mixer.active():
+                pcm = self.mixer.mix(None, self.volume * self.track_gain)
+                if pcm:
+                    self.mumble.sound_output.add_sound(pcm)
             else:
                 time.sleep(0.1)
 
@@ -741,48 +1218,186 @@ class MumbleBot:
                 if self.is_playing:
                     self.is_playing = False
                     self.next()
-                if len(var.playlist) > 0:
-                    music = var.playlist[0]
+                if self.preparing:
+                    if self.preparing[1].done() and not self.launch_prepared():
+                        self.next()
+                elif len(self.playlist) > 0:
+                    music = self.playlist[0]
                     if music['type'] in ['radio', 'file', 'url']:
-                        if not self.launch_music(music):
-                            self.next()
+                        self.start_preparing(music)
 
-        while self.mumble.sound_output.get_buffer_size() > 0:
+        while self.get_buffer_size() > 0:
             time.sleep(0.01)
         time.sleep(0.5)
 
         if self.exit:
             util.write_db()
+            var.library.save()
+
+    def users_changed(self, *args):
+        # pymumble thread, the listeners are counted by the audio loop
+        self.queue_work(self.update_listeners)
+
+    def count_listeners(self):
+        myself = self.mumble.users.myself
+        return sum(1 for user in list(self.mumble.users.values())
+                   if user['session'] != myself['session'] and user['channel_id'] == myself['channel_id']
+                   and not user.get('deaf') and not user.get('self_deaf'))
+
+    def update_listeners(self):
+        if self.count_listeners() > 0:
+            self.idle_since = None
+            if self.suspended:
+                self.resume()
+        elif self.idle_since is None:
+            self.idle_since = time.time()
+
+    def suspend(self):
+        # Nobody listens: stop decoding and sending. Files and URLs restart
+        # where they were, live streams from now, MIDI tracks (played by the
+        # bot's synth) simply wait.
+        logging.info('Nobody is listening, pausing')
+        self.suspended = True
+        self.discard_preparing()
+        music = self.playlist[0] if len(self.playlist) > 0 else None
+        if self.music_source and not (music and self.is_midi(music)):
+            # live streams restart from now
+            self.resume_position = 0
+            if music and music['type'] != 'radio':
+                self.resume_position = max(0, self.music_source.position - self.get_buffer_size())
+            self.music_source.stop()
+            self.music_source = None
+            self.is_playing = False
+        if self.mixer:
+            self.mixer.clear()
+        self.flush_output()
+        self.notify_change()
+
+    def resume(self):
+        logging.info('Someone joined, resuming')
+        self.suspended = False
+        self.notify_change()
+
+    def get_buffer_size(self):
+        return self.mumble.sound_output.get_buffer_size() + self.opus_output.get_buffer_size()
 
     def stop_current(self):
+        self.discard_preparing()
         if self.music_source:
             self.music_source.stop()
             self.music_source = None
         self.is_playing = False
+        self.notify_change()
 
     def stop_all(self):
         self.stop_current()
-        var.playlist = []
+        self.resume_position = None
+        if self.mixer:
+            self.mixer.clear()
+        self.flush_output()
+        self.playlist.clear()
+
+    def flush_output(self):
+        # drop the audio already queued, so that skip and stop are heard right
+        # away (with a short fade rather than a click)
+        media.output.fade_out(self.mumble.sound_output, var.config.getfloat('bot', 'fade_duration'))
+        self.opus_output.clear_buffer()
 
     def quit(self):
         self.stop_all()
         self.exit = True
 
     def set_comment(self):
-        self.mumble.users.myself.comment(var.config.get('bot', 'comment'))
+        self.mumble.users.myself.comment(self.get_option('bot', 'comment'))
 
     def send_msg(self, msg, text=None):
         msg = msg.encode('utf-8', 'ignore').decode('utf-8')
         if not text or not text.session:
-            own_channel = self.mumble.channels[self.mumble.users.myself['channel_id']]
-            own_channel.send_text_message(msg)
+            self.outbox.send_channel(self.mumble.users.myself['channel_id'], msg)
         else:
-            self.mumble.users[text.actor].send_text_message(msg)
+            self.outbox.send_user(text.actor, msg)
+
+    def send_user_msg(self, session, msg):
+        self.outbox.send_user(session, msg.encode('utf-8', 'ignore').decode('utf-8'))
 
 
 def start_web_interface(addr, port):
-    logging.info('Starting web interface on {}:{}'.format(addr, port))
-    interface.web.run(port=port, host=addr)
+    import interface
+    interface.serve(addr, port)
+
+
+def supervise_web_process(config_files):
+    # the web interface gets its own process (and GIL), and talks to the bots through the control socket
+    address = var.config.get('webinterface', 'ipc_socket')
+    authkey = os.urandom(32)
+    control.serve(address, authkey)
+    context = multiprocessing.get_context('spawn')
+    import interface
+    while True:
+        process = context.Process(target=interface.run_process, args=(config_files, address, authkey), name='web')
+        process.daemon = True
+        process.start()
+        process.join()
+        logging.error('Web interface process exited with code {}, restarting'.format(process.exitcode))
+        time.sleep(5)
+
+
+nb_exit = 0
+
+
+def ctrl_caught(signal, frame):
+    global nb_exit
+    logging.info("\nSIGINT caught, quitting, {} more to kill".format(2 - nb_exit))
+    for bot in var.bots:
+        bot.exit = True
+        bot.stop_all()
+    if nb_exit > 1:
+        logging.info("Forced Quit")
+        sys.exit(0)
+    nb_exit += 1
+
+
+def report_startup(phase, duration):
+    logging.info('Startup: {} took {:.3f}s'.format(phase, duration))
+    metrics.gauge('startup.' + phase.replace(' ', '_'), duration)
+
+
+def timed(phase, func, *args):
+    start = time.time()
+    result = func(*args)
+    report_startup(phase, time.time() - start)
+    return result
+
+
+def warm_up(phase, func):
+    def run():
+        try:
+            timed(phase, func)
+        except Exception as e:
+            logging.error('Startup: {} failed: {}'.format(phase, e))
+    t = threading.Thread(target=run, name='warmup')
+    t.daemon = True
+    t.start()
+
+
+def setup_logging(args):
+    FORMAT = '%(asctime)s: %(message)s'
+    loglevel = logging.INFO
+    if args.verbose:
+        loglevel = logging.DEBUG
+    elif args.quiet:
+        loglevel = logging.ERROR
+    logfile = var.config.get('bot', 'logfile')
+    if logfile:
+        logging.basicConfig(filename=logfile, format=FORMAT, level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    else:
+        logging.basicConfig(format=FORMAT, level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    if args.verbose:
+        logging.debug("Starting in DEBUG loglevel")
+    elif args.quiet:
+        logging.error("Starting in ERROR loglevel")
+    else:
+        logging.info("Starting in INFO loglevel")
 
 
 if __name__ == '__main__':
@@ -806,8 +1421,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     var.dbfile = args.db
-    config = configparser.ConfigParser(interpolation=None, allow_no_value=True)
-    parsed_configs = config.read(['configuration.default.ini', args.config], encoding='utf-8')
+    config = settings.Settings(['configuration.default.ini', args.config])
+    parsed_configs = config.parsed
 
     db = configparser.ConfigParser(interpolation=None, allow_no_value=True)
     db.read(var.dbfile, encoding='utf-8')
@@ -818,4 +1433,60 @@ if __name__ == '__main__':
 
     var.config = config
     var.db = db
-    botamusique = MumbleBot(args)
+    var.music_folder = var.config.get('bot', 'music_folder')
+    var.is_proxified = var.config.getboolean("webinterface", "is_web_proxified")
+    setup_logging(args)
+    signal.signal(signal.SIGINT, ctrl_caught)
+    report_startup('imports and configuration', time.time() - startup_time)
+
+    var.library = timed('library index', library.LibraryIndex, var.music_folder, var.config.get('bot', 'library_index'))
+    var.library.add_listener(media.loudness.submit_library)
+    var.library.add_listener(media.file.submit_library)
+    var.soundfonts = media.soundfont.SoundfontManager(var.config.get('bot', 'soundfont_folder'),
+                                                      var.config.getint('bot', 'soundfont_cache_size') * 1024 * 1024)
+
+    # warm up while the bots connect: scanning the library also starts the tag
+    # extraction and the loudness analysis in the background
+    warm_up('library scan', var.library.get_files)
+    warm_up('soundfont catalog', var.soundfonts.get_catalog)
+    warm_up('resolver', media.resolver.warm_up)
+    if var.config.getboolean('bot', 'dsp_process'):
+        warm_up('decoder processes', media.dsp.warm_up)
+
+    if var.config.getint('bot', 'config_reload_interval') > 0:
+        settings.watch(var.config.getint('bot', 'config_reload_interval'),
+                       lambda: [bot.apply_config() for bot in var.bots])
+
+    # One bot per [instance:name] section, or a single bot configured by [server] and the command line
+    instances = [section.split(':', 1)[1] for section in var.config.sections() if section.startswith('instance:')]
+    if instances:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(instances)) as pool:
+            var.bots = list(pool.map(lambda name: timed('connection of ' + name, MumbleBot, args, name), instances))
+    else:
+        var.bots = [timed('connection', MumbleBot, args)]
+
+    if var.config.getboolean("webinterface", "enabled"):
+        start = time.time()
+        if var.config.getboolean("webinterface", "separate_process"):
+            tt = threading.Thread(target=supervise_web_process, args=(['configuration.default.ini', args.config],))
+        else:
+            wi_addr = var.config.get("webinterface", "listening_addr")
+            wi_port = var.config.getint("webinterface", "listening_port")
+            var.controls = [control.BotControl(bot) for bot in var.bots]
+            import interface
+            interface.init_proxy()
+            tt = threading.Thread(target=start_web_interface, args=(wi_addr, wi_port))
+        tt.daemon = True
+        tt.start()
+        report_startup('web interface', time.time() - start)
+
+    report_startup('total', time.time() - startup_time)
+
+    threads = []
+    for bot in var.bots:
+        t = threading.Thread(target=bot.loop, name=bot.name or 'bot')
+        t.start()
+        threads.append(t)
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(1)
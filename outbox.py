@@ -0,0 +1,93 @@
+import collections
+import logging
+import threading
+import time
+import metrics
+
+
+class Outbox:
+    """Outgoing text messages of a bot, sent from their own thread.
+
+    Messages to the same target (a channel or a user) queued within `window`
+    seconds are packed together up to the server's maximum message length,
+    and messages are sent at most `rate` per second with bursts of `burst`,
+    like murmur's own rate limiter (messagelimit / messageburst). A rate of
+    0 sends them without limit.
+    """
+
+    def __init__(self, mumble, window=0.2, rate=1.0, burst=5):
+        self.mumble = mumble
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.time()
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()  # target -> (first queued time, [messages])
+        t = threading.Thread(target=self.run, name='outbox')
+        t.daemon = True
+        t.start()
+
+    def send_channel(self, channel_id, msg):
+        self.queue(('channel', channel_id), msg)
+
+    def send_user(self, session, msg):
+        self.queue(('user', session), msg)
+
+    def queue(self, target, msg):
+        with self.cond:
+            if target not in self.pending:
+                self.pending[target] = (time.time(), [])
+            self.pending[target][1].append(msg)
+            self.cond.notify()
+        metrics.incr('outbox.queued')
+
+    def pack(self, msgs):
+        maxlen = self.mumble.get_max_message_length()
+        packed = []
+        for msg in msgs:
+            if packed and '<img' not in msg and '<img' not in packed[-1] and \
+                    (not maxlen or len(packed[-1]) + len('<br />') + len(msg) <= maxlen):
+                packed[-1] += '<br />' + msg
+            else:
+                packed.append(msg)
+        return packed
+
+    def take_token(self):
+        if self.rate <= 0:
+            # no limit
+            return
+        while True:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                target, (queued, msgs) = next(iter(self.pending.items()))
+                delay = queued + self.window - time.time()
+                if delay > 0:
+                    # wait for more messages to the same target
+                    self.cond.wait(delay)
+                    continue
+                del self.pending[target]
+
+            for msg in self.pack(msgs):
+                self.take_token()
+                try:
+                    if target[0] == 'channel':
+                        self.mumble.channels[target[1]].send_text_message(msg)
+                    else:
+                        self.mumble.users[target[1]].send_text_message(msg)
+                    metrics.incr('outbox.sent')
+                except Exception as e:
+                    # the user left, or the message is too long
+                    logging.error('Could not send message to {} {}: {!r}'.format(target[0], target[1], e))
+                    metrics.incr('outbox.dropped')
@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import variables as var
+import metrics
+
+# Admission of the expensive commands (URL resolution, searches, playlists),
+# shared by every bot of the process. They run on a pool of resolver_workers
+# threads instead of the pymumble callback thread; each user has a token
+# bucket, requests beyond resolution_queue waiting ones are refused, and
+# admins skip the buckets and go first.
+
+_cond = threading.Condition()
+_tasks = []  # heap of (priority, sequence, func)
+_sequence = itertools.count()
+_workers = []
+_running = 0
+_buckets = {}  # user -> (tokens, time)
+
+
+def submit(user, is_admin, func, config=None):
+    """Run func() on the pool. Returns (status, value):
+
+    ('started', 0), ('deferred', number of requests ahead),
+    ('rate', seconds before the next request is accepted) or ('busy', 0).
+    """
+    config = config or var.config
+    rate = config.getfloat('bot', 'user_requests_per_minute') / 60
+    burst = config.getint('bot', 'user_requests_burst')
+    now = time.time()
+    with _cond:
+        if not is_admin:
+            # a rate of 0 disables the per-user limit
+            if rate > 0:
+                tokens, last = _buckets.get(user, (burst, now))
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens < 1:
+                    _buckets[user] = (tokens, now)
+                    metrics.incr('quota.rejected.rate')
+                    return 'rate', int((1 - tokens) / rate) + 1
+            if len(_tasks) >= config.getint('bot', 'resolution_queue'):
+                metrics.incr('quota.rejected.busy')
+                return 'busy', 0
+            if rate > 0:
+                _buckets[user] = (tokens - 1, now)
+
+        while len(_workers) < config.getint('bot', 'resolver_workers'):
+            t = threading.Thread(target=_worker, name='quota-{}'.format(len(_workers)))
+            t.daemon = True
+            t.start()
+            _workers.append(t)
+        priority = 0 if is_admin else 1
+        deferred = _running + len(_tasks) >= len(_workers)
+        ahead = sum(1 for task in _tasks if task[0] <= priority)
+        heapq.heappush(_tasks, (priority, next(_sequence), func))
+        metrics.gauge('quota.pending', len(_tasks))
+        _cond.notify()
+    if deferred:
+        metrics.incr('quota.deferred')
+        return 'deferred', ahead
+    metrics.incr('quota.admitted')
+    return 'started', 0
+
+
+def _worker():
+    global _running
+    while True:
+        with _cond:
+            while not _tasks:
+                _cond.wait()
+            priority, sequence, func = heapq.heappop(_tasks)
+            _running += 1
+            metrics.gauge('quota.pending', len(_tasks))
+            metrics.gauge('quota.running', _running)
+        try:
+            func()
+        except Exception as e:
+            logging.error('Request failed: {}'.format(e))
+        with _cond:
+            _running -= 1
+            metrics.gauge('quota.running', _running)
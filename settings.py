@@ -0,0 +1,170 @@
+import configparser
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+import variables as var
+
+_unset = object()
+
+# Options read as numbers or booleans. They are converted when a snapshot is
+# built, so that an invalid value makes reload() keep the current snapshot
+# instead of failing where it is read.
+typed_options = {
+    'bot': {
+        'volume': 'getfloat', 'tmp_folder_max_size': 'getint', 'announce_current_music': 'getboolean',
+        'allow_other_channel_message': 'getboolean', 'allow_private_message': 'getboolean',
+        'max_track_playlist': 'getint', 'playlist_resolve_ahead': 'getint', 'max_track_duration': 'getint',
+        'buffer_min': 'getfloat', 'buffer_max': 'getfloat', 'resolver_workers': 'getint',
+        'metadata_cache_ttl': 'getint', 'loudness_normalization': 'getboolean', 'loudness_target': 'getfloat',
+        'loudness_max_gain': 'getfloat', 'loudness_workers': 'getint', 'midi_cache': 'getboolean',
+        'midi_cache_max_size': 'getint', 'soundfont_cache_size': 'getint', 'opus_passthrough': 'getboolean',
+        'max_bandwidth': 'getint', 'min_bitrate': 'getint', 'dsp_process': 'getboolean', 'dsp_ring': 'getfloat', 'dsp_restarts': 'getint',
+        'idle_pause': 'getfloat', 'fade_duration': 'getfloat', 'sfx_gain': 'getfloat', 'duck_level': 'getfloat',
+        'duck_attack': 'getfloat', 'duck_release': 'getfloat', 'message_window': 'getfloat',
+        'message_rate': 'getfloat', 'message_burst': 'getint', 'search_results': 'getint',
+        'user_requests_per_minute': 'getfloat', 'user_requests_burst': 'getint', 'resolution_queue': 'getint',
+        'max_user_queue': 'getint', 'config_reload_interval': 'getint',
+    },
+    'webinterface': {
+        'enabled': 'getboolean', 'is_web_proxified': 'getboolean', 'listening_port': 'getint',
+        'production': 'getboolean', 'workers': 'getint', 'static_max_age': 'getint', 'event_streams': 'getint',
+        'gzip': 'getboolean', 'separate_process': 'getboolean', 'max_upload_size': 'getint',
+        'max_extracted_size': 'getint', 'max_extracted_files': 'getint',
+    },
+    'command': {'split_username_at_space': 'getboolean'},
+    'debug': {'ffmpeg': 'getboolean', 'mumbleConnection': 'getboolean'},
+}
+# [bot] options an [instance:name] section can override
+instance_typed_options = ['max_bandwidth', 'min_bitrate']
+
+
+def get_mtimes(files):
+    mtimes = []
+    for file in files:
+        try:
+            mtimes.append(os.path.getmtime(file))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+class Settings:
+    """Read-only snapshot of the configuration files.
+
+    It offers the read methods of ConfigParser (get, getint, getfloat,
+    getboolean, has_option, sections), typed values being converted once and
+    kept, plus precomputed values for the hot paths. Reloading builds a new
+    snapshot which replaces var.config in one assignment, so code holding a
+    snapshot always sees consistent values.
+    """
+
+    def __init__(self, files):
+        parser = configparser.ConfigParser(interpolation=None, allow_no_value=True)
+        self.files = list(files)
+        self.mtimes = get_mtimes(self.files)
+        self.parsed = parser.read(self.files, encoding='utf-8')
+        self.boolean_states = parser.BOOLEAN_STATES
+        self._sections = MappingProxyType({section: MappingProxyType(dict(parser.items(section)))
+                                           for section in parser.sections()})
+        self._typed = {}
+        self.validate()
+
+        self.admins = frozenset(self.get('bot', 'admin', '').split(';'))
+        self.command_symbol = self.get('command', 'command_symbol', '!')
+        self.split_username_at_space = self.getboolean('command', 'split_username_at_space', False)
+        # command typed by the users -> name of the option in [command]
+        self.commands = MappingProxyType({value: name for name, value in self._sections.get('command', {}).items()
+                                          if name not in ('command_symbol', 'split_username_at_space')})
+
+    def validate(self):
+        """Convert the typed options, raises ValueError if one is invalid."""
+        checks = [(section, option, getter) for section, options in typed_options.items()
+                  for option, getter in options.items()]
+        checks += [(section, option, 'getint') for section in self._sections if section.startswith('instance:')
+                   for option in instance_typed_options]
+        for section, option, getter in checks:
+            if not self.has_option(section, option):
+                continue
+            try:
+                getattr(self, getter)(section, option)
+            except ValueError as e:
+                raise ValueError('Invalid {} in [{}]: {}'.format(option, section, e))
+
+    def sections(self):
+        return list(self._sections)
+
+    def has_option(self, section, option):
+        return section in self._sections and option.lower() in self._sections[section]
+
+    def get(self, section, option, fallback=_unset):
+        try:
+            return self._sections[section][option.lower()]
+        except KeyError:
+            if fallback is not _unset:
+                return fallback
+            if section not in self._sections:
+                raise configparser.NoSectionError(section)
+            raise configparser.NoOptionError(option, section)
+
+    def _get_typed(self, convert, section, option, fallback):
+        key = (convert, section, option)
+        try:
+            return self._typed[key]
+        except KeyError:
+            pass
+        if fallback is not _unset and not self.has_option(section, option):
+            return fallback
+        value = self._typed[key] = convert(self.get(section, option))
+        return value
+
+    def _convert_boolean(self, value):
+        if value.lower() not in self.boolean_states:
+            raise ValueError('Not a boolean: %s' % value)
+        return self.boolean_states[value.lower()]
+
+    def getint(self, section, option, fallback=_unset):
+        return self._get_typed(int, section, option, fallback)
+
+    def getfloat(self, section, option, fallback=_unset):
+        return self._get_typed(float, section, option, fallback)
+
+    def getboolean(self, section, option, fallback=_unset):
+        return self._get_typed(self._convert_boolean, section, option, fallback)
+
+
+def reload():
+    """Replace var.config by a new snapshot of the same files, returns it.
+
+    The current snapshot is kept if the files can't be parsed or an option
+    has an invalid value.
+    """
+    settings = Settings(var.config.files)
+    if not settings.parsed:
+        raise ValueError('Could not read ' + ', '.join(var.config.files))
+    var.config = settings
+    logging.info('Configuration reloaded from ' + ', '.join(settings.parsed))
+    return settings
+
+
+def watch(interval, callback=None):
+    """Reload the configuration when one of its files changes."""
+    def run():
+        failed = None
+        while True:
+            time.sleep(interval)
+            mtimes = get_mtimes(var.config.files)
+            if mtimes == var.config.mtimes or mtimes == failed:
+                continue
+            try:
+                reload()
+            except Exception as e:
+                logging.error('Could not reload the configuration: {}'.format(e))
+                failed = mtimes
+                continue
+            if callback:
+                callback()
+    t = threading.Thread(target=run, name='settings')
+    t.daemon = True
+    t.start()
@@ -23,8 +23,12 @@ def get_recursive_filelist_sorted(path, only_audio=True):
             if not os.access(fullpath, os.R_OK):
                 continue
 
+            if not only_audio:
+                filelist.append(relroot + file)
+                continue
+
             mime = magic.from_file(fullpath, mime=True)
-            if not only_audio or ('audio' in mime or 'audio' in magic.from_file(fullpath).lower() or 'video' in mime):
+            if 'audio' in mime or 'audio' in magic.from_file(fullpath).lower() or 'video' in mime:
                 filelist.append(relroot + file)
 
     filelist.sort()
@@ -111,90 +115,3 @@ def url_unban(url):
     res = "Done"
     write_db()
     return res
-
-
-class Dir(object):
-    def __init__(self, path):
-        self.name = os.path.basename(path.strip('/'))
-        self.fullpath = path
-        self.subdirs = {}
-        self.files = []
-
-    def add_file(self, file):
-        if file.startswith(self.name + '/'):
-            file = file.replace(self.name + '/', '', 1)
-
-        if '/' in file:
-            # This file is in a subdir
-            subdir = file.split('/')[0]
-            if subdir in self.subdirs:
-                self.subdirs[subdir].add_file(file)
-            else:
-                self.subdirs[subdir] = Dir(os.path.join(self.fullpath, subdir))
-                self.subdirs[subdir].add_file(file)
-        else:
-            self.files.append(file)
-        return True
-
-    def get_subdirs(self, path=None):
-        subdirs = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                subdirs = self.subdirs[subdir].get_subdirs(searchpath)
-                subdirs = list(map(lambda subsubdir: os.path.join(subdir, subsubdir), subdirs))
-        else:
-            subdirs = self.subdirs
-
-        return subdirs
-
-    def get_subdirs_recursively(self, path=None):
-        subdirs = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                subdirs = self.subdirs[subdir].get_subdirs_recursively(searchpath)
-        else:
-            subdirs = list(self.subdirs.keys())
-
-            for key, val in self.subdirs.items():
-                subdirs.extend(map(lambda subdir: key + '/' + subdir, val.get_subdirs_recursively()))
-
-        subdirs.sort()
-        return subdirs
-
-    def get_files(self, path=None):
-        files = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                files = self.subdirs[subdir].get_files(searchpath)
-        else:
-            files = self.files
-
-        return files
-
-    def get_files_recursively(self, path=None):
-        files = []
-        if path and path != '' and path != './':
-            subdir = path.split('/')[0]
-            if subdir in self.subdirs:
-                searchpath = '/'.join(path.split('/')[1::])
-                files = self.subdirs[subdir].get_files_recursively(searchpath)
-        else:
-            files = self.files
-
-            for key, val in self.subdirs.items():
-                files.extend(map(lambda file: key + '/' + file, val.get_files_recursively()))
-
-        return files
-
-    def render_text(self, ident=0):
-        print('{}{}/'.format(' ' * (ident * 4), self.name))
-        for key, val in self.subdirs.items():
-            val.render_text(ident + 1)
-        for file in self.files:
-            print('{}{}'.format(' ' * (ident + 1) * 4, file))
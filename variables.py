@@ -1,6 +1,8 @@
 current_music = None
-playlist = []
-user = ""
+bots = []
+controls = []
+library = None
+soundfonts = None
 music_folder = ""
 is_proxified = False
 dbfile = None